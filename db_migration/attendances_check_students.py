@@ -6,6 +6,7 @@ import psycopg2
 from dotenv import load_dotenv
 from pymongo import MongoClient
 from collections import defaultdict
+from mongo_stream import stream_collection
 
 # Configuration du logging
 logging.basicConfig(
@@ -51,15 +52,6 @@ def check_students(mongo_db, pg_conn):
     """Vérifie la correspondance des étudiants entre MongoDB et Supabase"""
     cur = None
     try:
-        # Récupérer toutes les présences de MongoDB
-        attendances = list(mongo_db.attendancenews.find())
-        total_attendances = len(attendances)
-        logger.info(f"Nombre total de présences dans MongoDB: {total_attendances}")
-
-        if total_attendances == 0:
-            logger.warning("Aucune présence trouvée dans MongoDB")
-            return
-
         # Récupérer tous les étudiants de Supabase
         cur = pg_conn.cursor()
         cur.execute("SELECT id, mongo_id FROM education.users")
@@ -67,29 +59,30 @@ def check_students(mongo_db, pg_conn):
         total_supabase_users = len(supabase_users)
         logger.info(f"Nombre total d'utilisateurs dans Supabase: {total_supabase_users}")
 
-        # Collecter tous les IDs d'étudiants uniques de MongoDB
-        mongo_student_ids = set()
+        # Parcourir les présences de MongoDB en streaming, en une seule passe,
+        # en ne lisant que les IDs des étudiants
+        total_attendances = 0
+        student_usage = defaultdict(int)
+        attendances = stream_collection(mongo_db, 'attendancenews', {'records.student': 1})
         for attendance in attendances:
+            total_attendances += 1
             for record in attendance.get('records', []):
-                mongo_student_ids.add(str(record['student']))
+                student_usage[str(record['student'])] += 1
+
+        logger.info(f"Nombre total de présences dans MongoDB: {total_attendances}")
 
+        if total_attendances == 0:
+            logger.warning("Aucune présence trouvée dans MongoDB")
+            return
+
+        # Collecter tous les IDs d'étudiants uniques de MongoDB
+        mongo_student_ids = set(student_usage)
         total_mongo_students = len(mongo_student_ids)
         logger.info(f"Nombre total d'étudiants uniques dans MongoDB: {total_mongo_students}")
 
         # Vérifier les correspondances
-        found_students = set()
-        not_found_students = set()
-        student_usage = defaultdict(int)
-
-        for attendance in attendances:
-            for record in attendance.get('records', []):
-                student_id = str(record['student'])
-                student_usage[student_id] += 1
-
-                if student_id in supabase_users:
-                    found_students.add(student_id)
-                else:
-                    not_found_students.add(student_id)
+        found_students = mongo_student_ids & supabase_users.keys()
+        not_found_students = mongo_student_ids - found_students
 
         # Calculer les statistiques
         total_found = len(found_students)
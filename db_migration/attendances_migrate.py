@@ -1,11 +1,17 @@
 import os
 import sys
+import time
+import argparse
+import uuid
 import logging
 from datetime import datetime
 import psycopg2
 from dotenv import load_dotenv
 from pymongo import MongoClient
 from collections import defaultdict
+from mongo_stream import iter_chunks, stream_collection
+from record_rates import presence_rates
+from pg_copy import copy_rows, copy_with_savepoint_fallback
 
 # Configuration du logging
 logging.basicConfig(
@@ -17,6 +23,27 @@ logger = logging.getLogger(__name__)
 # Chargement des variables d'environnement
 load_dotenv()
 
+# Nombre de présences traitées et validées par transaction
+ATTENDANCE_CHUNK_SIZE = 500
+
+# Colonnes chargées via COPY dans education.attendances et education.attendance_records
+ATTENDANCE_COLUMNS = (
+    'id', 'course_id', 'date', 'presence_rate', 'total_students',
+    'last_update', 'created_at', 'updated_at', 'is_active', 'deleted_at'
+)
+ATTENDANCE_RECORD_COLUMNS = (
+    'attendance_id', 'student_id', 'is_present', 'comment', 'created_at', 'updated_at'
+)
+
+# Champs MongoDB lus par la migration des présences
+ATTENDANCE_PROJECTION = {
+    'course': 1,
+    'date': 1,
+    'records': 1,
+    'createdAt': 1,
+    'updatedAt': 1
+}
+
 def connect_mongodb():
     """Connexion à MongoDB"""
     try:
@@ -47,13 +74,81 @@ def connect_supabase():
         logger.error(f"Erreur de connexion à Supabase: {str(e)}")
         raise
 
-def migrate_attendances(mongo_db, pg_conn):
-    """Migration des présences de MongoDB vers Supabase"""
+def load_session_map(pg_conn):
+    """Charge une seule fois le mapping course_session_mongo_id -> (session, cours)"""
+    cur = pg_conn.cursor()
+    try:
+        cur.execute("""
+            SELECT cs.course_session_mongo_id, cs.id, c.id as course_id
+            FROM education.courses_sessions cs
+            JOIN education.courses c ON c.id = cs.course_id
+            WHERE cs.course_session_mongo_id IS NOT NULL
+        """)
+        sessions = {str(row[0]): (row[1], row[2]) for row in cur.fetchall()}
+        logger.info(f"Sessions de cours préchargées: {len(sessions)}")
+        return sessions
+    finally:
+        cur.close()
+
+def build_attendance_rows(attendance, course_id, presence_rate, total_students, supabase_users):
+    """Construit la ligne d'une présence et celles de ses records, avec un ID de présence généré côté Python"""
+    attendance_id = str(uuid.uuid4())
+    attendance_row = (
+        attendance_id,
+        course_id,
+        attendance['date'],
+        presence_rate,
+        total_students,
+        attendance.get('updatedAt', datetime.now()),
+        attendance.get('createdAt', datetime.now()),
+        attendance.get('updatedAt', datetime.now()),
+        True,  # is_active
+        None   # deleted_at
+    )
+
+    record_rows = []
+    missing = defaultdict(int)
+    invalid = 0
+    for record in attendance.get('records', []):
+        # Un record sans étudiant est écarté et compté, sans annuler la présence
+        if not record.get('student'):
+            logger.warning(f"Record sans étudiant ignoré dans l'attendance {attendance['_id']}")
+            invalid += 1
+            continue
+
+        student_mongo_id = str(record['student'])
+        if student_mongo_id not in supabase_users:
+            missing[student_mongo_id] += 1
+            continue
+
+        record_rows.append((
+            attendance_id,
+            supabase_users[student_mongo_id],
+            record.get('isPresent', False),
+            record.get('comment', None),
+            record.get('createdAt', datetime.now()),
+            record.get('updatedAt', datetime.now())
+        ))
+
+    return attendance_row, record_rows, missing, invalid
+
+def copy_attendance_rows(cur, prepared):
+    """Charge des présences préparées puis leurs records via COPY FROM STDIN"""
+    copy_rows(
+        cur, 'education.attendances', ATTENDANCE_COLUMNS,
+        [attendance_row for _, attendance_row, _, _, _ in prepared]
+    )
+    copy_rows(
+        cur, 'education.attendance_records', ATTENDANCE_RECORD_COLUMNS,
+        [row for _, _, record_rows, _, _ in prepared for row in record_rows]
+    )
+
+def migrate_attendances(mongo_db, pg_conn, chunk_size=ATTENDANCE_CHUNK_SIZE):
+    """Migration des présences de MongoDB vers Supabase, chargée via COPY par lots de chunk_size présences"""
     cur = None
     try:
-        # Récupérer toutes les présences de MongoDB
-        attendances = list(mongo_db.attendancenews.find())
-        total_attendances = len(attendances)
+        # Parcourir les présences de MongoDB en streaming
+        total_attendances = mongo_db.attendancenews.estimated_document_count()
         logger.info(f"Nombre total de présences à migrer: {total_attendances}")
 
         if total_attendances == 0:
@@ -65,95 +160,71 @@ def migrate_attendances(mongo_db, pg_conn):
         cur.execute("SELECT id, mongo_id FROM education.users")
         supabase_users = {str(row[1]): row[0] for row in cur.fetchall()}
 
+        # Récupérer toutes les sessions de cours
+        sessions = load_session_map(pg_conn)
+        pg_conn.commit()
+
         migrated_count = 0
         error_count = 0
         records_migrated = 0
         records_error = 0
         missing_students = defaultdict(int)
+        start = time.perf_counter()
 
-        for attendance in attendances:
-            try:
-                # Trouver l'ID Supabase de la session
-                cur.execute("""
-                    SELECT cs.id, c.id as course_id
-                    FROM education.courses_sessions cs
-                    JOIN education.courses c ON c.id = cs.course_id
-                    WHERE cs.course_session_mongo_id = %s
-                """, (str(attendance['course']),))
-                session = cur.fetchone()
-
-                if not session:
-                    logger.warning(f"Session non trouvée pour l'attendance {attendance['_id']}")
-                    error_count += 1
-                    continue
-
-                session_id, course_id = session
-
-                # Calculer le taux de présence
-                records = attendance.get('records', [])
-                total_students = len(records)
-                present_count = sum(1 for r in records if r.get('isPresent', False))
-                presence_rate = (present_count / total_students * 100) if total_students > 0 else 0
-
-                # Insérer l'attendance
-                cur.execute("""
-                    INSERT INTO education.attendances
-                    (course_id, date, presence_rate, total_students, last_update, created_at, updated_at, is_active, deleted_at)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    RETURNING id
-                """, (
-                    course_id,
-                    attendance['date'],
-                    presence_rate,
-                    total_students,
-                    attendance.get('updatedAt', datetime.now()),
-                    attendance.get('createdAt', datetime.now()),
-                    attendance.get('updatedAt', datetime.now()),
-                    True,  # is_active
-                    None   # deleted_at
-                ))
-                attendance_id = cur.fetchone()[0]
-
-                # Insérer les records de présence
-                for record in records:
-                    try:
-                        student_mongo_id = str(record['student'])
-                        if student_mongo_id not in supabase_users:
-                            missing_students[student_mongo_id] += 1
-                            records_error += 1
-                            continue
-
-                        cur.execute("""
-                            INSERT INTO education.attendance_records
-                            (attendance_id, student_id, is_present, comment, created_at, updated_at)
-                            VALUES (%s, %s, %s, %s, %s, %s)
-                        """, (
-                            attendance_id,
-                            supabase_users[student_mongo_id],
-                            record.get('isPresent', False),
-                            record.get('comment', None),
-                            record.get('createdAt', datetime.now()),
-                            record.get('updatedAt', datetime.now())
-                        ))
-                        records_migrated += 1
-
-                    except Exception as e:
-                        logger.error(f"Erreur lors de la migration du record {record['_id']}: {str(e)}")
-                        records_error += 1
+        attendances = stream_collection(mongo_db, 'attendancenews', ATTENDANCE_PROJECTION)
+        for chunk in iter_chunks(attendances, chunk_size):
+            chunk_start = time.perf_counter()
+
+            # Taux de présence et nombre d'étudiants de tout le lot en une passe vectorisée
+            rates, totals = presence_rates(chunk)
+
+            # Construire en mémoire les lignes du lot
+            prepared = []
+            for attendance, presence_rate, total_students in zip(chunk, rates, totals):
+                try:
+                    # Trouver l'ID Supabase de la session
+                    session = sessions.get(str(attendance['course']))
+                    if not session:
+                        logger.warning(f"Session non trouvée pour l'attendance {attendance['_id']}")
+                        error_count += 1
                         continue
 
-                migrated_count += 1
-                if migrated_count % 100 == 0:
-                    logger.info(f"Progression: {migrated_count}/{total_attendances}")
+                    session_id, course_id = session
+                    prepared.append((
+                        attendance,
+                        *build_attendance_rows(attendance, course_id, presence_rate, total_students, supabase_users)
+                    ))
+                except Exception as e:
+                    # Document incomplet (date ou cours manquant) : écarté sans arrêter la migration
+                    logger.error(f"Erreur lors de la préparation de l'attendance {attendance.get('_id')}: {str(e)}")
+                    error_count += 1
+                    records_error += len(attendance.get('records') or [])
 
-            except Exception as e:
+            # Charger tout le lot via COPY, présence par présence si le lot échoue
+            loaded, failed = copy_with_savepoint_fallback(pg_conn, cur, prepared, copy_attendance_rows)
+            for (attendance, _, _, _, _), e in failed:
                 logger.error(f"Erreur lors de la migration de l'attendance {attendance['_id']}: {str(e)}")
                 error_count += 1
-                continue
+                records_error += len(attendance.get('records') or [])
 
-        pg_conn.commit()
+            for _, _, record_rows, missing, invalid in loaded:
+                migrated_count += 1
+                records_migrated += len(record_rows)
+                records_error += invalid
+                for student_mongo_id, count in missing.items():
+                    missing_students[student_mongo_id] += count
+                    records_error += count
+
+            chunk_elapsed = time.perf_counter() - chunk_start
+            rate = len(loaded) / chunk_elapsed if chunk_elapsed > 0 else float(len(loaded))
+            logger.info(
+                f"Progression: {migrated_count}/{total_attendances} "
+                f"(lot de {len(loaded)} présences en {chunk_elapsed:.2f}s, {rate:.0f} présences/s)"
+            )
+
+        elapsed = time.perf_counter() - start
         logger.info("\nStatistiques de migration:")
-        logger.info(f"Présences migrées avec succès: {migrated_count}/{total_attendances}")
+        logger.info(f"Présences migrées avec succès: {migrated_count}/{total_attendances} en {elapsed:.2f}s")
         logger.info(f"Erreurs de migration des présences: {error_count}")
         logger.info(f"Records de présence migrés avec succès: {records_migrated}")
         logger.info(f"Erreurs de migration des records: {records_error}")
@@ -172,8 +243,20 @@ def migrate_attendances(mongo_db, pg_conn):
         if cur:
             cur.close()
 
+def parse_args():
+    """Analyse les arguments de la ligne de commande"""
+    parser = argparse.ArgumentParser(description="Migration des présences de MongoDB vers Supabase")
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=ATTENDANCE_CHUNK_SIZE,
+        help=f"Nombre de présences validées par transaction (défaut: {ATTENDANCE_CHUNK_SIZE})"
+    )
+    return parser.parse_args()
+
 def main():
     """Fonction principale"""
+    args = parse_args()
     try:
         logger.info("Connexion à MongoDB...")
         mongo_db = connect_mongodb()
@@ -182,7 +265,7 @@ def main():
         pg_conn = connect_supabase()
 
         logger.info("Début de la migration des présences...")
-        migrate_attendances(mongo_db, pg_conn)
+        migrate_attendances(mongo_db, pg_conn, args.chunk_size)
         logger.info("Migration terminée !")
 
     except Exception as e:
@@ -8,7 +8,14 @@ from psycopg2.extras import Json
 import uuid
 from dotenv import load_dotenv
 import sys
+import argparse
+from bisect import bisect_left
 from bson.objectid import ObjectId
+from mongo_stream import iter_chunks, stream_collection
+from pg_copy import copy_rows, copy_with_savepoint_fallback
+from record_rates import behavior_rates
+from mongo_profile import profile_database
+from user_uuid import load_user_ids, resolve_user_ids
 
 # Configuration du logging
 logging.basicConfig(
@@ -24,6 +31,26 @@ logger = logging.getLogger(__name__)
 # Chargement des variables d'environnement
 load_dotenv()
 
+# Champs MongoDB lus par la migration des behaviors
+BEHAVIOR_PROJECTION = {
+    'course': 1,
+    'date': 1,
+    'records': 1,
+    'created_at': 1
+}
+
+# Nombre de behaviors chargés par transaction
+BEHAVIOR_CHUNK_SIZE = 500
+
+# Colonnes chargées via COPY dans education.behaviors et education.behavior_records
+BEHAVIOR_COLUMNS = (
+    'id', 'course_session_id', 'date', 'behavior_rate', 'total_students',
+    'last_update', 'is_active', 'created_at', 'updated_at'
+)
+BEHAVIOR_RECORD_COLUMNS = (
+    'id', 'behavior_id', 'student_id', 'rating', 'comment', 'created_at', 'updated_at'
+)
+
 def connect_mongodb():
     """Connexion à MongoDB"""
     try:
@@ -57,28 +84,27 @@ def connect_supabase():
 def check_course_mapping(mongo_db, pg_conn, course_mapping):
     """Vérifie la correspondance des cours entre MongoDB et Supabase"""
     try:
-        # Récupérer tous les comportements
-        behaviors = list(mongo_db.behaviornews.find({}, {'course': 1}))
-        logger.info(f"Nombre total de comportements à vérifier: {len(behaviors)}")
+        # Extraire les IDs des cours uniques référencés par les comportements
+        unique_course_ids = set(str(course_id) for course_id in mongo_db.behaviornews.distinct('course'))
+        logger.info(f"Nombre de cours uniques à vérifier: {len(unique_course_ids)}")
 
-        # Extraire les IDs des cours uniques
-        unique_course_ids = set(str(behavior['course']) for behavior in behaviors)
+        # Index inversé du mapping : nouveau cours -> anciens cours
+        old_ids_by_new_id = {}
+        for old_id, new_id in course_mapping.items():
+            old_ids_by_new_id.setdefault(new_id, []).append(old_id)
 
-        # Vérifier les correspondances dans Supabase
+        # Récupérer en une requête les détails des cours mappés présents dans Supabase
         cursor = pg_conn.cursor()
-        found_courses = set()
-        missing_courses = set()
-
-        # Récupérer les détails des cours dans Supabase
         cursor.execute("""
             SELECT c.id, c.mongo_id, c.academic_year, c.created_at,
                    cs.subject, cs.level
             FROM education.courses c
             LEFT JOIN education.courses_sessions cs ON cs.course_id = c.id
-            WHERE c.mongo_id IN %s
-        """, (tuple(course_mapping.values()),))
+            WHERE c.mongo_id = ANY(%s)
+        """, (list(old_ids_by_new_id),))
 
         course_details = cursor.fetchall()
+        cursor.close()
 
         logger.info("\nDétails des cours dans Supabase:")
         for course in course_details:
@@ -90,27 +116,17 @@ def check_course_mapping(mongo_db, pg_conn, course_mapping):
                 logger.info(f"  Matière: {course[4]}")
                 logger.info(f"  Niveau: {course[5]}")
             logger.info("  Anciens cours mappés:")
-            for old_id, new_id in course_mapping.items():
-                if new_id == course[1]:
-                    logger.info(f"    * {old_id}")
+            for old_id in old_ids_by_new_id.get(course[1], []):
+                logger.info(f"    * {old_id}")
             logger.info("")
 
-        for old_course_id in unique_course_ids:
-            if old_course_id in course_mapping:
-                new_course_id = course_mapping[old_course_id]
-                cursor.execute(
-                    "SELECT id FROM education.courses WHERE mongo_id = %s",
-                    (new_course_id,)
-                )
-                result = cursor.fetchone()
-                if result:
-                    found_courses.add(old_course_id)
-                else:
-                    missing_courses.add(old_course_id)
-            else:
-                missing_courses.add(old_course_id)
-
-        cursor.close()
+        # Un ancien cours est couvert si son nouveau cours existe dans Supabase
+        existing_new_ids = {course[1] for course in course_details}
+        found_courses = {
+            old_course_id for old_course_id in unique_course_ids
+            if course_mapping.get(old_course_id) in existing_new_ids
+        }
+        missing_courses = unique_course_ids - found_courses
 
         # Afficher les statistiques
         logger.info("\nStatistiques de correspondance des cours:")
@@ -132,30 +148,26 @@ def check_course_mapping(mongo_db, pg_conn, course_mapping):
 def explore_mongodb_structure(mongo_db):
     """Explore la structure des données MongoDB pour trouver les collections pertinentes"""
     try:
-        # Lister toutes les collections
-        collections = mongo_db.list_collection_names()
+        # Profiler toutes les collections en parallèle, sur un échantillon $sample
+        profile = profile_database(mongo_db)
+
         logger.info("\nCollections disponibles dans MongoDB:")
-        for collection in collections:
-            count = mongo_db[collection].count_documents({})
-            logger.info(f"- {collection}: {count} documents")
-
-            # Si c'est une collection de cours, afficher un exemple
-            if 'course' in collection.lower():
-                sample = mongo_db[collection].find_one()
-                if sample:
-                    logger.info(f"  Exemple de document dans {collection}:")
-                    logger.info(f"  ID: {sample.get('_id')}")
-                    logger.info(f"  Nom: {sample.get('name', 'N/A')}")
-                    logger.info(f"  Autres champs: {list(sample.keys())}")
+        for collection, collection_profile in profile['collections'].items():
+            logger.info(f"- {collection}: ~{collection_profile['estimated_count']} documents")
+
+            # Si c'est une collection de cours, afficher ses champs
+            if 'course' in collection.lower() and collection_profile['sampled']:
+                logger.info(f"  Champs de {collection}: {list(collection_profile['fields'])}")
 
         # Vérifier la structure des comportements
-        behavior_sample = mongo_db.behaviornews.find_one()
-        if behavior_sample:
+        behavior_fields = profile['collections'].get('behaviornews', {}).get('fields', {})
+        if behavior_fields:
             logger.info("\nStructure d'un comportement:")
-            logger.info(f"Champs disponibles: {list(behavior_sample.keys())}")
-            if 'course' in behavior_sample:
-                logger.info(f"Type de course: {type(behavior_sample['course'])}")
-                logger.info(f"Valeur de course: {behavior_sample['course']}")
+            logger.info(f"Champs disponibles: {list(behavior_fields)}")
+            if 'course' in behavior_fields:
+                logger.info(f"Types de course: {behavior_fields['course']['types']}")
+
+        return profile
 
     except Exception as e:
         logger.error(f"Erreur lors de l'exploration: {str(e)}")
@@ -195,35 +207,47 @@ def analyze_course_migration(mongo_db):
         logger.error(f"Erreur lors de l'analyse: {str(e)}")
         raise
 
+def find_closest_course(new_courses, timestamps, behavior_date):
+    """Trouve par dichotomie le cours dont la date de création est la plus proche"""
+    i = bisect_left(timestamps, behavior_date)
+    if i == 0:
+        return new_courses[0]
+    if i == len(timestamps):
+        return new_courses[bisect_left(timestamps, timestamps[-1])]
+
+    # À égalité de distance, garder le cours le plus ancien (premier des ex aequo)
+    before, after = timestamps[i - 1], timestamps[i]
+    if behavior_date - before <= after - behavior_date:
+        return new_courses[bisect_left(timestamps, before)]
+    return new_courses[i]
+
 def create_course_mapping(mongo_db):
     """Crée un mapping entre les anciens et nouveaux cours basé sur les dates"""
     try:
-        # Récupérer tous les comportements avec leurs dates
-        behaviors = list(mongo_db.behaviornews.find({}, {'course': 1, 'date': 1}))
-
         # Récupérer tous les nouveaux cours avec leurs dates
-        new_courses = list(mongo_db.coursenews.find({}, {
-            '_id': 1,
-            'createdAt': 1,
-            'sessions': 1,
-            'teacher': 1
-        }))
+        new_courses = [
+            course for course in mongo_db.coursenews.find({}, {'_id': 1, 'createdAt': 1})
+            if course.get('createdAt')
+        ]
 
         # Trier les cours par date de création
-        new_courses.sort(key=lambda x: x.get('createdAt', ''))
-
-        # Créer un mapping basé sur les dates
+        new_courses.sort(key=lambda x: x['createdAt'])
+        timestamps = [course['createdAt'] for course in new_courses]
+
+        # Ne garder que la date du dernier comportement de chaque ancien cours :
+        # c'est elle qui détermine le mapping final
+        behaviors_count = 0
+        last_dates = {}
+        for behavior in stream_collection(mongo_db, 'behaviornews', {'course': 1, 'date': 1}):
+            behaviors_count += 1
+            if behavior.get('date'):
+                last_dates[str(behavior['course'])] = behavior['date']
+
+        # Créer un mapping basé sur les dates, une recherche par ancien cours
         course_mapping = {}
-        for behavior in behaviors:
-            old_course_id = str(behavior['course'])
-            behavior_date = behavior.get('date')
-
-            if behavior_date:
-                # Trouver le cours le plus proche en date
-                closest_course = min(
-                    new_courses,
-                    key=lambda x: abs((x.get('createdAt', '') - behavior_date).total_seconds())
-                )
+        if new_courses:
+            for old_course_id, behavior_date in last_dates.items():
+                closest_course = find_closest_course(new_courses, timestamps, behavior_date)
                 course_mapping[old_course_id] = str(closest_course['_id'])
 
         # Afficher le mapping
@@ -233,7 +257,7 @@ def create_course_mapping(mongo_db):
 
         # Vérifier la qualité du mapping
         logger.info(f"\nNombre de mappings créés: {len(course_mapping)}")
-        logger.info(f"Nombre de comportements: {len(behaviors)}")
+        logger.info(f"Nombre de comportements: {behaviors_count}")
 
         return course_mapping
 
@@ -241,123 +265,152 @@ def create_course_mapping(mongo_db):
         logger.error(f"Erreur lors de la création du mapping: {str(e)}")
         raise
 
-def migrate_behaviors(mongo_db, pg_conn, course_mapping):
-    """Migre les behaviors de MongoDB vers Supabase"""
+def load_session_map(pg_conn, course_mapping):
+    """Charge en une requête une session de cours par nouveau cours mappé"""
+    cur = pg_conn.cursor()
+    try:
+        cur.execute("""
+            SELECT DISTINCT ON (c.mongo_id) c.mongo_id, cs.id
+            FROM education.courses c
+            JOIN education.courses_sessions cs ON cs.course_id = c.id
+            WHERE c.mongo_id = ANY(%s)
+            ORDER BY c.mongo_id
+        """, (list(set(course_mapping.values())),))
+        sessions = dict(cur.fetchall())
+        logger.info(f"Sessions de cours préchargées: {len(sessions)}")
+        return sessions
+    finally:
+        cur.close()
+
+def load_student_map(pg_conn):
+    """Charge en une requête le mapping mongo_id -> UUID des utilisateurs"""
+    cur = pg_conn.cursor()
+    try:
+        cur.execute("SELECT mongo_id, id FROM education.users")
+        students = dict(cur.fetchall())
+        logger.info(f"Utilisateurs préchargés: {len(students)}")
+        return students
+    finally:
+        cur.close()
+
+def build_behavior_rows(behavior, course_session_id, student_ids, behavior_rate, total_students):
+    """Construit la ligne d'un behavior et celles de ses records, avec des UUID générés côté Python"""
+    now = datetime.now()
+    behavior_id = str(uuid.uuid4())
+    created_at = behavior.get('created_at', now)
+    records = behavior.get('records') or []
+
+    behavior_row = (
+        behavior_id,
+        course_session_id,
+        behavior.get('date', now),
+        behavior_rate,
+        total_students,
+        now,
+        True,
+        created_at,
+        now
+    )
+
+    record_rows = []
+    for record, student_id in zip(records, student_ids):
+        if not student_id:
+            logger.error(f"Étudiant {record.get('student')} non trouvé dans Supabase")
+            continue
+        record_rows.append((
+            str(uuid.uuid4()),
+            behavior_id,
+            student_id,
+            record.get('rating', 0),
+            record.get('comment'),
+            created_at,
+            now
+        ))
+
+    return behavior_row, record_rows
+
+def copy_behavior_rows(cur, prepared):
+    """Charge des behaviors préparés puis leurs records via COPY FROM STDIN"""
+    copy_rows(cur, 'education.behaviors', BEHAVIOR_COLUMNS, [behavior_row for _, behavior_row, _ in prepared])
+    copy_rows(
+        cur, 'education.behavior_records', BEHAVIOR_RECORD_COLUMNS,
+        [row for _, _, record_rows in prepared for row in record_rows]
+    )
+
+def migrate_behaviors(mongo_db, pg_conn, course_mapping, user_ids=None, chunk_size=BEHAVIOR_CHUNK_SIZE):
+    """Migre les behaviors de MongoDB vers Supabase, par lots chargés via COPY.
+
+    Sessions et étudiants sont résolus depuis des mappings préchargés. Si user_ids
+    (UUID des utilisateurs existants) est fourni, l'ID de chaque étudiant est calculé
+    depuis son ObjectId au lieu d'être lu dans le mapping des utilisateurs.
+    """
     try:
-        # Récupérer tous les behaviors de MongoDB
-        behaviors = list(mongo_db.behaviornews.find())
-        logger.info(f"\nDébut de la migration des {len(behaviors)} behaviors...")
+        # Parcourir les behaviors de MongoDB en streaming
+        total_behaviors = mongo_db.behaviornews.estimated_document_count()
+        behaviors = stream_collection(mongo_db, 'behaviornews', BEHAVIOR_PROJECTION)
+        logger.info(f"\nDébut de la migration des {total_behaviors} behaviors...")
+
+        sessions = load_session_map(pg_conn, course_mapping)
+        students = load_student_map(pg_conn) if user_ids is None else None
+        pg_conn.commit()
 
         cursor = pg_conn.cursor()
         migrated = 0
         errors = 0
 
-        for behavior in behaviors:
-            try:
-                # Obtenir le nouveau course_id (UUID Supabase)
-                old_course_id = str(behavior['course'])
-                if old_course_id not in course_mapping:
-                    logger.error(f"Pas de mapping trouvé pour le cours {old_course_id}")
-                    errors += 1
-                    continue
+        for chunk in iter_chunks(behaviors, chunk_size):
+            prepared = []
+
+            # behavior_rate et total_students de tout le lot en une passe vectorisée
+            rates, totals = behavior_rates(chunk)
 
-                # Récupérer l'ID Supabase de la session de cours
-                cursor.execute("""
-                    SELECT cs.id
-                    FROM education.courses c
-                    JOIN education.courses_sessions cs ON cs.course_id = c.id
-                    WHERE c.mongo_id = %s
-                    LIMIT 1
-                """, (course_mapping[old_course_id],))
-                session_result = cursor.fetchone()
-                if not session_result:
-                    logger.error(f"Session de cours non trouvée pour le cours {course_mapping[old_course_id]}")
+            for behavior, behavior_rate, total_students in zip(chunk, rates, totals):
+                # Note manquante ou non numérique : le behavior est écarté sans arrêter le lot
+                if behavior_rate is None:
+                    logger.error(f"Note invalide dans le behavior {behavior['_id']}")
                     errors += 1
                     continue
-                course_session_id = session_result[0]
-
-                # Calculer behavior_rate et total_students
-                records = behavior.get('records', [])
-                total_students = len(records)
-                if total_students > 0:
-                    behavior_rate = sum(r.get('rating', 0) for r in records) / total_students
-                else:
-                    behavior_rate = 0
-
-                # Insérer le behavior dans Supabase
-                cursor.execute("""
-                    INSERT INTO education.behaviors (
-                        id,
-                        course_session_id,
-                        date,
-                        behavior_rate,
-                        total_students,
-                        last_update,
-                        is_active,
-                        created_at,
-                        updated_at
-                    ) VALUES (
-                        gen_random_uuid(),
-                        %s, %s, %s, %s, %s, %s, %s, %s
-                    ) RETURNING id
-                """, (
-                    course_session_id,  # UUID Supabase de la session
-                    behavior.get('date', datetime.now()),
-                    behavior_rate,
-                    total_students,
-                    datetime.now(),
-                    True,
-                    behavior.get('created_at', datetime.now()),
-                    datetime.now()
-                ))
-
-                behavior_id = cursor.fetchone()[0]
-
-                # Insérer les records
-                for record in records:
-                    # Récupérer l'ID Supabase de l'étudiant
-                    cursor.execute(
-                        "SELECT id FROM education.users WHERE mongo_id = %s",
-                        (str(record.get('student', '')),)
-                    )
-                    student_result = cursor.fetchone()
-                    if not student_result:
-                        logger.error(f"Étudiant {record.get('student')} non trouvé dans Supabase")
+
+                try:
+                    # Obtenir le nouveau course_id (UUID Supabase)
+                    old_course_id = str(behavior['course'])
+                    if old_course_id not in course_mapping:
+                        logger.error(f"Pas de mapping trouvé pour le cours {old_course_id}")
+                        errors += 1
                         continue
-                    student_id = student_result[0]
-
-                    cursor.execute("""
-                        INSERT INTO education.behavior_records (
-                            id,
-                            behavior_id,
-                            student_id,
-                            rating,
-                            comment,
-                            created_at,
-                            updated_at
-                        ) VALUES (
-                            gen_random_uuid(),
-                            %s, %s, %s, %s, %s, %s
-                        )
-                    """, (
-                        behavior_id,  # UUID Supabase
-                        student_id,   # UUID Supabase
-                        record.get('rating', 0),
-                        record.get('comment'),
-                        behavior.get('created_at', datetime.now()),
-                        datetime.now()
-                    ))
 
-                migrated += 1
-                if migrated % 50 == 0:
-                    logger.info(f"{migrated} behaviors migrés...")
+                    # Récupérer l'ID Supabase de la session de cours
+                    course_session_id = sessions.get(course_mapping[old_course_id])
+                    if not course_session_id:
+                        logger.error(f"Session de cours non trouvée pour le cours {course_mapping[old_course_id]}")
+                        errors += 1
+                        continue
+
+                    # IDs Supabase des étudiants, calculés ou lus dans le mapping
+                    records = behavior.get('records') or []
+                    if user_ids is not None:
+                        student_ids = resolve_user_ids([record.get('student', '') for record in records], user_ids)
+                    else:
+                        student_ids = [students.get(str(record.get('student', ''))) for record in records]
+
+                    prepared.append((
+                        behavior,
+                        *build_behavior_rows(behavior, course_session_id, student_ids, behavior_rate, total_students)
+                    ))
+                except Exception as e:
+                    # Document incomplet (cours manquant, records invalides) : écarté sans arrêter la migration
+                    logger.error(f"Erreur lors de la préparation du behavior {behavior.get('_id')}: {str(e)}")
+                    errors += 1
 
-            except Exception as e:
+            # Charger tout le lot via COPY, behavior par behavior si le lot échoue
+            loaded, failed = copy_with_savepoint_fallback(pg_conn, cursor, prepared, copy_behavior_rows)
+            migrated += len(loaded)
+            for (behavior, _, _), e in failed:
                 logger.error(f"Erreur lors de la migration du behavior {behavior['_id']}: {str(e)}")
                 errors += 1
-                continue
 
-        pg_conn.commit()
+            logger.info(f"{migrated} behaviors migrés...")
+
         cursor.close()
 
         logger.info(f"\nMigration terminée:")
@@ -368,8 +421,25 @@ def migrate_behaviors(mongo_db, pg_conn, course_mapping):
         logger.error(f"Erreur lors de la migration des behaviors: {str(e)}")
         raise
 
+def parse_args():
+    """Analyse les arguments de la ligne de commande"""
+    parser = argparse.ArgumentParser(description="Migration des behaviors de MongoDB vers Supabase")
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=BEHAVIOR_CHUNK_SIZE,
+        help=f"Nombre de behaviors chargés par transaction (défaut: {BEHAVIOR_CHUNK_SIZE})"
+    )
+    parser.add_argument(
+        '--computed-ids',
+        action='store_true',
+        help="Calcule l'ID des étudiants depuis leur ObjectId au lieu d'une requête par record"
+    )
+    return parser.parse_args()
+
 def main():
     """Fonction principale"""
+    args = parse_args()
     try:
         logger.info("Connexion à MongoDB...")
         mongo_db = connect_mongodb()
@@ -386,7 +456,8 @@ def main():
 
         # Migrer les behaviors
         logger.info("Début de la migration des behaviors...")
-        migrate_behaviors(mongo_db, pg_conn, course_mapping)
+        user_ids = load_user_ids(pg_conn) if args.computed_ids else None
+        migrate_behaviors(mongo_db, pg_conn, course_mapping, user_ids, args.chunk_size)
 
     except Exception as e:
         logger.error(f"Erreur: {str(e)}")
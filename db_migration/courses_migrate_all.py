@@ -2,15 +2,25 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
-import json
+import time
+import argparse
 import logging
 from datetime import datetime
 from pymongo import MongoClient
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2.pool import ThreadedConnectionPool
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import Json, execute_values
 import uuid
 import traceback
 from bson.objectid import ObjectId
+from collections import defaultdict
+from pg_copy import COPY_CHUNK_SIZE, copy_rows
+from pg_constraints import add_constraints
+from mongo_stream import stream_collection
+from mongo_id_index import load_existing_mongo_ids, skip_existing
+from id_map_store import open_id_map
+from user_uuid import load_user_ids, resolve_user_ids, verify_user_references
 
 # Configuration du logging
 logging.basicConfig(
@@ -23,6 +33,69 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Fréquence des logs de progression par shard en mode parallèle
+SHARD_PROGRESS_EVERY = 50
+
+# Champs MongoDB lus par la migration des cours
+COURSE_PROJECTION = {
+    'academicYear': 1,
+    'isActive': 1,
+    'createdAt': 1,
+    'updatedAt': 1,
+    'teacher': 1,
+    'sessions': 1
+}
+
+# Nom du high-water mark des cours dans education.migration_watermarks
+COURSE_WATERMARK = 'coursenews'
+
+# Contraintes des tables des cours, dans l'ordre où elles peuvent être ajoutées :
+# clés primaires, index uniques, puis clés étrangères
+COURSE_CONSTRAINTS = [
+    ('courses_pkey', 'courses', 'PRIMARY KEY (id)'),
+    ('courses_sessions_pkey', 'courses_sessions', 'PRIMARY KEY (id)'),
+    ('courses_sessions_timeslot_pkey', 'courses_sessions_timeslot', 'PRIMARY KEY (id)'),
+    ('courses_sessions_students_pkey', 'courses_sessions_students', 'PRIMARY KEY (id)'),
+    ('courses_teacher_pkey', 'courses_teacher', 'PRIMARY KEY (id)'),
+    ('courses_mongo_id_key', 'courses', 'UNIQUE (mongo_id)'),
+    ('courses_sessions_mongo_id_key', 'courses_sessions', 'UNIQUE (mongo_id)'),
+    ('courses_sessions_course_id_fkey', 'courses_sessions',
+     'FOREIGN KEY (course_id) REFERENCES education.courses(id)'),
+    ('courses_sessions_timeslot_course_sessions_id_fkey', 'courses_sessions_timeslot',
+     'FOREIGN KEY (course_sessions_id) REFERENCES education.courses_sessions(id)'),
+    ('courses_sessions_students_course_sessions_id_fkey', 'courses_sessions_students',
+     'FOREIGN KEY (course_sessions_id) REFERENCES education.courses_sessions(id)'),
+    ('courses_sessions_students_student_id_fkey', 'courses_sessions_students',
+     'FOREIGN KEY (student_id) REFERENCES education.users(id)'),
+    ('courses_teacher_course_id_fkey', 'courses_teacher',
+     'FOREIGN KEY (course_id) REFERENCES education.courses(id)'),
+    ('courses_teacher_teacher_id_fkey', 'courses_teacher',
+     'FOREIGN KEY (teacher_id) REFERENCES education.users(id)'),
+]
+
+# Colonnes insérées pour chaque table du graphe des cours,
+# dans l'ordre de chargement imposé par les clés étrangères
+COURSE_TABLE_COLUMNS = {
+    'courses': (
+        'id', 'mongo_id', 'academic_year', 'is_active', 'created_at'
+    ),
+    'courses_teacher': (
+        'id', 'course_id', 'mongo_teacher_id', 'created_at', 'teacher_id'
+    ),
+    'courses_sessions': (
+        'id', 'course_id', 'mongo_id', 'course_session_mongo_id', 'subject', 'level',
+        'stats_average_attendance', 'stats_average_grade', 'stats_average_behavior',
+        'stats_last_updated', 'created_at'
+    ),
+    'courses_sessions_timeslot': (
+        'id', 'course_sessions_id', 'day_of_week', 'start_time', 'end_time',
+        'classroom_number', 'created_at'
+    ),
+    'courses_sessions_students': (
+        'id', 'course_sessions_id', 'mongo_student_id', 'created_at', 'student_id'
+    ),
+}
+
 def connect_mongodb():
     """Connexion à MongoDB"""
     try:
@@ -81,16 +154,17 @@ def drop_tables(pg_conn):
     finally:
         cur.close()
 
-def create_tables(pg_conn):
-    """Crée les tables dans Supabase"""
+def create_tables(pg_conn, defer_constraints=False):
+    """Crée les tables dans Supabase, avec leurs contraintes sauf si elles sont différées"""
     try:
         cur = pg_conn.cursor()
+        start = time.perf_counter()
 
         # Table des cours
         cur.execute("""
             CREATE TABLE IF NOT EXISTS education.courses (
-                id UUID PRIMARY KEY,
-                mongo_id TEXT NOT NULL UNIQUE,
+                id UUID NOT NULL,
+                mongo_id TEXT NOT NULL,
                 academic_year INTEGER NOT NULL,
                 is_active BOOLEAN DEFAULT true,
                 created_at TIMESTAMP WITH TIME ZONE,
@@ -101,9 +175,9 @@ def create_tables(pg_conn):
         # Table des sessions
         cur.execute("""
             CREATE TABLE IF NOT EXISTS education.courses_sessions (
-                id UUID PRIMARY KEY,
-                course_id UUID REFERENCES education.courses(id),
-                mongo_id TEXT NOT NULL UNIQUE,
+                id UUID NOT NULL,
+                course_id UUID,
+                mongo_id TEXT NOT NULL,
                 course_session_mongo_id TEXT NOT NULL,
                 subject TEXT NOT NULL,
                 level TEXT NOT NULL,
@@ -119,8 +193,8 @@ def create_tables(pg_conn):
         # Table des créneaux horaires
         cur.execute("""
             CREATE TABLE IF NOT EXISTS education.courses_sessions_timeslot (
-                id UUID PRIMARY KEY,
-                course_sessions_id UUID REFERENCES education.courses_sessions(id),
+                id UUID NOT NULL,
+                course_sessions_id UUID,
                 day_of_week TEXT NOT NULL,
                 start_time TIME NOT NULL,
                 end_time TIME NOT NULL,
@@ -133,10 +207,10 @@ def create_tables(pg_conn):
         # Table des étudiants des sessions
         cur.execute("""
             CREATE TABLE IF NOT EXISTS education.courses_sessions_students (
-                id UUID PRIMARY KEY,
-                course_sessions_id UUID REFERENCES education.courses_sessions(id),
+                id UUID NOT NULL,
+                course_sessions_id UUID,
                 mongo_student_id TEXT NOT NULL,
-                student_id UUID REFERENCES education.users(id),
+                student_id UUID,
                 created_at TIMESTAMP WITH TIME ZONE,
                 updated_at TIMESTAMP WITH TIME ZONE
             );
@@ -145,17 +219,17 @@ def create_tables(pg_conn):
         # Table des enseignants
         cur.execute("""
             CREATE TABLE IF NOT EXISTS education.courses_teacher (
-                id UUID PRIMARY KEY,
-                course_id UUID REFERENCES education.courses(id),
+                id UUID NOT NULL,
+                course_id UUID,
                 mongo_teacher_id TEXT NOT NULL,
-                teacher_id UUID REFERENCES education.users(id),
+                teacher_id UUID,
                 created_at TIMESTAMP WITH TIME ZONE,
                 updated_at TIMESTAMP WITH TIME ZONE
             );
         """)
 
         pg_conn.commit()
-        logger.info("Tables créées avec succès")
+        logger.info(f"Tables créées avec succès en {time.perf_counter() - start:.2f}s")
 
     except Exception as e:
         pg_conn.rollback()
@@ -164,20 +238,24 @@ def create_tables(pg_conn):
     finally:
         cur.close()
 
+    if defer_constraints:
+        logger.info("Contraintes différées: elles seront ajoutées après le chargement")
+    else:
+        add_constraints(pg_conn, COURSE_CONSTRAINTS)
+
 def get_mongo_courses(db):
-    """Récupère tous les cours depuis MongoDB"""
+    """Renvoie un itérateur en streaming sur les cours MongoDB"""
     try:
         # Vérifier que la collection existe
         if 'coursenews' not in db.list_collection_names():
             raise ValueError("La collection 'coursenews' n'existe pas dans MongoDB")
 
-        courses = list(db.coursenews.find())
-        if not courses:
+        count = db.coursenews.estimated_document_count()
+        if not count:
             logger.warning("Aucun cours trouvé dans MongoDB")
-            return []
 
-        logger.info(f"Nombre de cours trouvés dans MongoDB: {len(courses)}")
-        return courses
+        logger.info(f"Nombre de cours trouvés dans MongoDB: {count}")
+        return stream_collection(db, 'coursenews', COURSE_PROJECTION)
     except Exception as e:
         logger.error(f"Erreur lors de la récupération des cours MongoDB: {str(e)}")
         raise
@@ -196,202 +274,267 @@ def convert_level(level):
             return 0
     return 0
 
-def migrate_course(pg_conn, mongo_course):
+def migrate_course(pg_conn, mongo_course, check_existing=True, user_ids=None):
     """Migre un cours de MongoDB vers Supabase"""
     try:
         cur = pg_conn.cursor()
 
-        # Vérifier que le cours n'existe pas déjà
-        cur.execute("""
-            SELECT id FROM education.courses
-            WHERE mongo_id = %s
-        """, (str(mongo_course['_id']),))
+        # Vérifier que le cours n'existe pas déjà (déjà filtré en amont en mode reprise)
+        if check_existing:
+            cur.execute("""
+                SELECT id FROM education.courses
+                WHERE mongo_id = %s
+            """, (str(mongo_course['_id']),))
 
-        if cur.fetchone():
-            logger.warning(f"Le cours {mongo_course['_id']} existe déjà dans Supabase, il sera ignoré")
-            return
+            if cur.fetchone():
+                logger.warning(f"Le cours {mongo_course['_id']} existe déjà dans Supabase, il sera ignoré")
+                return
 
-        # Vérifier les champs obligatoires
-        if 'academicYear' not in mongo_course:
-            logger.warning(f"Le cours {mongo_course['_id']} n'a pas d'année académique, utilisation de l'année courante")
-            mongo_course['academicYear'] = datetime.now().year
+        # Construire le graphe complet avec des UUID générés côté Python,
+        # puis l'insérer avec un INSERT multi-lignes par table
+        rows = build_course_rows(mongo_course, user_ids)
+        insert_course_rows(cur, rows)
 
-        # Insérer le cours
-        cur.execute("""
-            INSERT INTO education.courses (
-                id,
-                mongo_id,
-                academic_year,
-                is_active,
-                created_at
-            ) VALUES (
-                gen_random_uuid(),
-                %s,
-                %s,
-                %s,
-                %s
-            ) RETURNING id
-        """, (
-            str(mongo_course['_id']),
-            mongo_course.get('academicYear'),
-            mongo_course.get('isActive', True),
-            mongo_course.get('createdAt', datetime.now())
-        ))
-        course_id = cur.fetchone()[0]
+        pg_conn.commit()
+        logger.info(f"Migration réussie pour le cours {mongo_course['_id']}")
+
+    except Exception as e:
+        pg_conn.rollback()
+        logger.error(f"Erreur lors de la migration du cours {mongo_course['_id']}: {str(e)}")
+        raise
+    finally:
+        cur.close()
 
-        # Insérer les enseignants
-        for teacher_id in mongo_course.get('teacher', []):
-            if not teacher_id:
-                logger.warning(f"ID enseignant vide trouvé dans le cours {mongo_course['_id']}")
+def compute_course_shards(db, workers):
+    """Découpe coursenews en plages d'_id de tailles équilibrées, une par worker"""
+    buckets = list(db.coursenews.aggregate([
+        {'$bucketAuto': {'groupBy': '$_id', 'buckets': workers}}
+    ]))
+
+    shards = []
+    for i, bucket in enumerate(buckets):
+        # $bucketAuto renvoie des bornes max exclusives, sauf pour le dernier bucket
+        upper = '$lte' if i == len(buckets) - 1 else '$lt'
+        shards.append({'_id': {'$gte': bucket['_id']['min'], upper: bucket['_id']['max']}})
+        logger.info(f"Shard {i + 1}: {bucket['count']} cours ({bucket['_id']['min']} -> {bucket['_id']['max']})")
+    return shards
+
+def migrate_course_shard(pool, db, shard_number, query, existing_ids=None, user_ids=None, check_existing=True):
+    """Migre une plage de cours sur sa propre connexion, en isolant les cours en erreur"""
+    pg_conn = pool.getconn()
+    migrated = 0
+    failed = 0
+    try:
+        mongo_courses = stream_collection(db, 'coursenews', COURSE_PROJECTION, query)
+        if existing_ids is not None:
+            mongo_courses = skip_existing(mongo_courses, pg_conn, 'education.courses', existing_ids)
+
+        for course in mongo_courses:
+            try:
+                migrate_course(pg_conn, course, check_existing=check_existing and existing_ids is None, user_ids=user_ids)
+                migrated += 1
+            except Exception:
+                # migrate_course a déjà annulé sa transaction et journalisé l'erreur
+                failed += 1
                 continue
 
-            cur.execute("""
-                INSERT INTO education.courses_teacher (
-                    id,
-                    course_id,
-                    mongo_teacher_id,
-                    created_at
-                ) VALUES (
-                    gen_random_uuid(),
-                    %s,
-                    %s,
-                    %s
-                )
-            """, (
-                course_id,
-                str(teacher_id),
-                mongo_course.get('createdAt', datetime.now())
-            ))
+            if migrated % SHARD_PROGRESS_EVERY == 0:
+                logger.info(f"Shard {shard_number}: {migrated} cours migrés, {failed} en erreur")
 
-        # Insérer les sessions
-        for session in mongo_course.get('sessions', []):
-            if not session.get('_id'):
-                logger.warning(f"Session sans ID trouvée dans le cours {mongo_course['_id']}")
-                continue
+        logger.info(f"Shard {shard_number} terminé: {migrated} cours migrés, {failed} en erreur")
+        return migrated, failed
+    finally:
+        pool.putconn(pg_conn)
 
-            cur.execute("""
-                INSERT INTO education.courses_sessions (
-                    id,
-                    course_id,
-                    mongo_id,
-                    course_session_mongo_id,
-                    subject,
-                    level,
-                    stats_average_attendance,
-                    stats_average_grade,
-                    stats_average_behavior,
-                    stats_last_updated,
-                    created_at
-                ) VALUES (
-                    gen_random_uuid(),
-                    %s,
-                    %s,
-                    %s,
-                    %s,
-                    %s,
-                    %s,
-                    %s,
-                    %s,
-                    %s,
-                    %s
-                ) RETURNING id
-            """, (
-                course_id,
-                str(session['_id']),
-                str(session['_id']),
-                session.get('subject', ''),
-                str(session.get('level', '')),
-                session.get('stats', {}).get('averageAttendance'),
-                session.get('stats', {}).get('averageGrade'),
-                session.get('stats', {}).get('averageBehavior'),
-                session.get('stats', {}).get('lastUpdated'),
-                mongo_course.get('createdAt', datetime.now())
+def migrate_courses_parallel(db, workers, existing_ids=None, user_ids=None, check_existing=True):
+    """Migre les cours en parallèle, un shard d'_id par worker et une connexion du pool par shard"""
+    shards = compute_course_shards(db, workers)
+    if not shards:
+        logger.warning("Aucun cours trouvé dans MongoDB")
+        return 0, 0
+
+    pool = ThreadedConnectionPool(1, len(shards), os.getenv('NEXT_PUBLIC_SUPABASE_URL'))
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+            futures = [
+                executor.submit(migrate_course_shard, pool, db, i, query, existing_ids, user_ids, check_existing)
+                for i, query in enumerate(shards, 1)
+            ]
+
+        total_migrated = 0
+        total_failed = 0
+        for i, future in enumerate(futures, 1):
+            try:
+                migrated, failed = future.result()
+                total_migrated += migrated
+                total_failed += failed
+            except Exception as e:
+                logger.error(f"Shard {i} interrompu: {str(e)}")
+
+        elapsed = time.perf_counter() - start
+        logger.info(f"Migration parallèle terminée en {elapsed:.2f}s: {total_migrated} cours migrés, {total_failed} en erreur")
+        return total_migrated, total_failed
+    finally:
+        pool.closeall()
+
+def build_course_rows(mongo_course, user_ids=None):
+    """Construit en mémoire les lignes d'un cours et de ses enfants, avec des UUID générés côté Python.
+
+    Si user_ids (UUID des utilisateurs existants) est fourni, teacher_id et student_id
+    sont calculés à partir des ObjectId au lieu d'être résolus après coup.
+    """
+    rows = {table: [] for table in COURSE_TABLE_COLUMNS}
+
+    # Vérifier les champs obligatoires
+    if 'academicYear' not in mongo_course:
+        logger.warning(f"Le cours {mongo_course['_id']} n'a pas d'année académique, utilisation de l'année courante")
+        mongo_course['academicYear'] = datetime.now().year
+
+    created_at = mongo_course.get('createdAt', datetime.now())
+    course_id = str(uuid.uuid4())
+
+    rows['courses'].append((
+        course_id,
+        str(mongo_course['_id']),
+        mongo_course.get('academicYear'),
+        mongo_course.get('isActive', True),
+        created_at
+    ))
+
+    teachers = []
+    for teacher_id in mongo_course.get('teacher', []):
+        if not teacher_id:
+            logger.warning(f"ID enseignant vide trouvé dans le cours {mongo_course['_id']}")
+            continue
+        teachers.append(teacher_id)
+
+    teacher_uuids = resolve_user_ids(teachers, user_ids) if user_ids is not None else [None] * len(teachers)
+    for teacher_id, teacher_uuid in zip(teachers, teacher_uuids):
+        rows['courses_teacher'].append((
+            str(uuid.uuid4()),
+            course_id,
+            str(teacher_id),
+            created_at,
+            teacher_uuid
+        ))
+
+    for session in mongo_course.get('sessions', []):
+        if not session.get('_id'):
+            logger.warning(f"Session sans ID trouvée dans le cours {mongo_course['_id']}")
+            continue
+
+        session_id = str(uuid.uuid4())
+        stats = session.get('stats', {})
+        rows['courses_sessions'].append((
+            session_id,
+            course_id,
+            str(session['_id']),
+            str(session['_id']),
+            session.get('subject', ''),
+            str(session.get('level', '')),
+            stats.get('averageAttendance'),
+            stats.get('averageGrade'),
+            stats.get('averageBehavior'),
+            stats.get('lastUpdated'),
+            created_at
+        ))
+
+        if 'timeSlot' in session:
+            rows['courses_sessions_timeslot'].append((
+                str(uuid.uuid4()),
+                session_id,
+                session['timeSlot'].get('dayOfWeek', ''),
+                session['timeSlot'].get('startTime'),
+                session['timeSlot'].get('endTime'),
+                session['timeSlot'].get('classroomNumber', ''),
+                created_at
             ))
-            session_id = cur.fetchone()[0]
-
-            # Insérer le créneau horaire
-            if 'timeSlot' in session:
-                cur.execute("""
-                    INSERT INTO education.courses_sessions_timeslot (
-                        id,
-                        course_sessions_id,
-                        day_of_week,
-                        start_time,
-                        end_time,
-                        classroom_number,
-                        created_at
-                    ) VALUES (
-                        gen_random_uuid(),
-                        %s,
-                        %s,
-                        %s,
-                        %s,
-                        %s,
-                        %s
-                    )
-                """, (
-                    session_id,
-                    session['timeSlot'].get('dayOfWeek', ''),
-                    session['timeSlot'].get('startTime'),
-                    session['timeSlot'].get('endTime'),
-                    session['timeSlot'].get('classroomNumber', ''),
-                    mongo_course.get('createdAt', datetime.now())
-                ))
-
-            # Insérer les étudiants
-            for student_id in session.get('students', []):
-                if not student_id:
-                    logger.warning(f"ID étudiant vide trouvé dans la session {session['_id']}")
-                    continue
 
-                cur.execute("""
-                    INSERT INTO education.courses_sessions_students (
-                        id,
-                        course_sessions_id,
-                        mongo_student_id,
-                        created_at
-                    ) VALUES (
-                        gen_random_uuid(),
-                        %s,
-                        %s,
-                        %s
-                    )
-                """, (
-                    session_id,
-                    str(student_id),
-                    mongo_course.get('createdAt', datetime.now())
-                ))
+        students = []
+        for student_id in session.get('students', []):
+            if not student_id:
+                logger.warning(f"ID étudiant vide trouvé dans la session {session['_id']}")
+                continue
+            students.append(student_id)
+
+        student_uuids = resolve_user_ids(students, user_ids) if user_ids is not None else [None] * len(students)
+        for student_id, student_uuid in zip(students, student_uuids):
+            rows['courses_sessions_students'].append((
+                str(uuid.uuid4()),
+                session_id,
+                str(student_id),
+                created_at,
+                student_uuid
+            ))
 
-        pg_conn.commit()
-        logger.info(f"Migration réussie pour le cours {mongo_course['_id']}")
+    return rows
+
+def insert_course_rows(cur, rows):
+    """Insère les lignes du graphe des cours avec un INSERT multi-lignes par table"""
+    for table, columns in COURSE_TABLE_COLUMNS.items():
+        if rows[table]:
+            execute_values(
+                cur,
+                f"INSERT INTO education.{table} ({', '.join(columns)}) VALUES %s",
+                rows[table]
+            )
+
+def flush_course_rows(cur, rows):
+    """Envoie via COPY les lignes accumulées pour chaque table du graphe des cours"""
+    counts = {}
+    for table, columns in COURSE_TABLE_COLUMNS.items():
+        counts[table] = copy_rows(cur, f"education.{table}", columns, rows[table])
+        rows[table].clear()
+    return counts
+
+def bulk_load_courses(pg_conn, mongo_courses, chunk_size=COPY_CHUNK_SIZE, user_ids=None):
+    """Charge tous les cours via COPY FROM STDIN, par lots de chunk_size cours (tables vides attendues)"""
+    try:
+        cur = pg_conn.cursor()
+        start = time.perf_counter()
+        rows = {table: [] for table in COURSE_TABLE_COLUMNS}
+        totals = {table: 0 for table in COURSE_TABLE_COLUMNS}
+        pending = 0
+
+        for mongo_course in mongo_courses:
+            for table, course_rows in build_course_rows(mongo_course, user_ids).items():
+                rows[table].extend(course_rows)
+            pending += 1
+
+            if pending >= chunk_size:
+                for table, count in flush_course_rows(cur, rows).items():
+                    totals[table] += count
+                pg_conn.commit()
+                logger.info(f"Lot COPY validé: {totals['courses']} cours chargés")
+                pending = 0
+
+        if pending:
+            for table, count in flush_course_rows(cur, rows).items():
+                totals[table] += count
+            pg_conn.commit()
+
+        elapsed = time.perf_counter() - start
+        logger.info(f"Chargement COPY terminé en {elapsed:.2f}s:")
+        for table, count in totals.items():
+            logger.info(f"- education.{table}: {count} lignes")
+        return totals
 
     except Exception as e:
         pg_conn.rollback()
-        logger.error(f"Erreur lors de la migration du cours {mongo_course['_id']}: {str(e)}")
+        logger.error(f"Erreur lors du chargement COPY des cours: {str(e)}")
         raise
     finally:
         cur.close()
 
 def load_id_mapping():
-    """Charge le mapping des IDs depuis le fichier JSON"""
+    """Ouvre le mapping binaire des IDs partagé (régénéré depuis le JSON si besoin)"""
     try:
-        mapping_file = './mongo_to_supabase_ids.json'
-        if not os.path.exists(mapping_file):
-            raise FileNotFoundError(f"Le fichier {mapping_file} n'existe pas")
+        mapping = open_id_map()
 
-        with open(mapping_file, 'r') as f:
-            data = json.load(f)
-
-        # Créer un mapping direct mongo_id -> supabase_id
-        mapping = {}
-        for user_data in data.values():
-            mongo_id = user_data.get('mongo_id')
-            supabase_id = user_data.get('supabase_id')
-            if mongo_id and supabase_id:
-                mapping[mongo_id] = supabase_id
-
-        if not mapping:
-            raise ValueError("Aucun mapping valide trouvé dans le fichier JSON")
+        if not len(mapping):
+            mapping.close()
+            raise ValueError("Aucun mapping valide trouvé dans le fichier de mapping")
 
         logger.info(f"Mapping chargé: {len(mapping)} entrées")
         return mapping
@@ -399,39 +542,295 @@ def load_id_mapping():
         logger.error(f"Erreur lors du chargement du mapping: {str(e)}")
         raise
 
-def update_teacher_ids(pg_conn, id_mapping):
-    """Met à jour les teacher_id en utilisant le mapping"""
+def read_course_watermark(db):
+    """Lit dans MongoDB le plus grand updatedAt et le plus grand _id de coursenews"""
+    latest_update = db.coursenews.find_one(
+        {'updatedAt': {'$exists': True}},
+        {'updatedAt': 1},
+        sort=[('updatedAt', -1)]
+    )
+    latest_id = db.coursenews.find_one({}, {'_id': 1}, sort=[('_id', -1)])
+    return (
+        latest_update['updatedAt'] if latest_update else None,
+        str(latest_id['_id']) if latest_id else None
+    )
+
+def ensure_watermark_table(cur):
+    """Crée si besoin la table des high-water marks"""
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS education.migration_watermarks (
+            name TEXT PRIMARY KEY,
+            last_updated_at TIMESTAMP WITH TIME ZONE,
+            last_mongo_id TEXT,
+            pending_mongo_ids TEXT[],
+            synced_at TIMESTAMP WITH TIME ZONE
+        );
+    """)
+    # Tables créées avant le suivi des documents en erreur
+    cur.execute("""
+        ALTER TABLE education.migration_watermarks
+        ADD COLUMN IF NOT EXISTS pending_mongo_ids TEXT[]
+    """)
+
+def load_watermark(pg_conn, name):
+    """Charge le high-water mark enregistré à la fin de la dernière synchronisation, et les documents à reprendre"""
     try:
         cur = pg_conn.cursor()
+        ensure_watermark_table(cur)
+        cur.execute("""
+            SELECT last_updated_at, last_mongo_id, pending_mongo_ids
+            FROM education.migration_watermarks
+            WHERE name = %s
+        """, (name,))
+        result = cur.fetchone()
+        pg_conn.commit()
+        if not result:
+            return None, None, []
+        return result[0], result[1], list(result[2] or [])
+    except Exception as e:
+        pg_conn.rollback()
+        logger.error(f"Erreur lors du chargement du high-water mark {name}: {str(e)}")
+        raise
+    finally:
+        cur.close()
 
-        # Récupérer tous les enregistrements
+def save_watermark(pg_conn, name, last_updated_at, last_mongo_id, pending_mongo_ids=()):
+    """Enregistre le high-water mark atteint par la synchronisation et les documents en erreur à reprendre"""
+    try:
+        cur = pg_conn.cursor()
+        ensure_watermark_table(cur)
         cur.execute("""
-            SELECT id, mongo_teacher_id
-            FROM education.courses_teacher
-            WHERE teacher_id IS NULL
-        """)
-        records = cur.fetchall()
+            INSERT INTO education.migration_watermarks (name, last_updated_at, last_mongo_id, pending_mongo_ids, synced_at)
+            VALUES (%s, %s, %s, %s, now())
+            ON CONFLICT (name) DO UPDATE SET
+                last_updated_at = EXCLUDED.last_updated_at,
+                last_mongo_id = EXCLUDED.last_mongo_id,
+                pending_mongo_ids = EXCLUDED.pending_mongo_ids,
+                synced_at = EXCLUDED.synced_at
+        """, (name, last_updated_at, last_mongo_id, list(pending_mongo_ids)))
+        pg_conn.commit()
+        logger.info(
+            f"High-water mark {name} enregistré: updatedAt={last_updated_at}, _id={last_mongo_id}, "
+            f"{len(pending_mongo_ids)} documents à reprendre"
+        )
+    except Exception as e:
+        pg_conn.rollback()
+        logger.error(f"Erreur lors de l'enregistrement du high-water mark {name}: {str(e)}")
+        raise
+    finally:
+        cur.close()
+
+def session_references(cur):
+    """Liste les (table, colonne) qui référencent courses_sessions par clé étrangère, hors tables enfants du cours"""
+    cur.execute("""
+        SELECT c.conrelid::regclass::text, a.attname
+        FROM pg_constraint c
+        JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = c.conkey[1]
+        WHERE c.contype = 'f'
+        AND c.confrelid = 'education.courses_sessions'::regclass
+    """)
+    # Les créneaux et étudiants des sessions sont supprimés juste avant
+    return [
+        (table, column) for table, column in cur.fetchall()
+        if table.split('.')[-1] not in ('courses_sessions_timeslot', 'courses_sessions_students')
+    ]
+
+def upsert_course(pg_conn, mongo_course, user_ids=None):
+    """Insère ou met à jour un cours et remplace ses lignes enfants, en gardant les UUID existants"""
+    try:
+        cur = pg_conn.cursor()
+        rows = build_course_rows(mongo_course, user_ids)
+        updated_at = mongo_course.get('updatedAt', datetime.now())
+
+        # Upsert du cours, en récupérant l'UUID déjà attribué le cas échéant
+        cur.execute("""
+            INSERT INTO education.courses (
+                id, mongo_id, academic_year, is_active, created_at, updated_at
+            ) VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (mongo_id) DO UPDATE SET
+                academic_year = EXCLUDED.academic_year,
+                is_active = EXCLUDED.is_active,
+                updated_at = EXCLUDED.updated_at
+            RETURNING id
+        """, rows['courses'][0] + (updated_at,))
+        course_id = cur.fetchone()[0]
+        rows['courses'].clear()
+
+        # Upsert des sessions : leurs UUID restent stables pour les notes, présences et comportements
+        session_ids = {}
+        if rows['courses_sessions']:
+            session_rows = [
+                (row[0], course_id) + row[2:] + (updated_at,)
+                for row in rows['courses_sessions']
+            ]
+            columns = COURSE_TABLE_COLUMNS['courses_sessions'] + ('updated_at',)
+            returned = execute_values(cur, f"""
+                INSERT INTO education.courses_sessions ({', '.join(columns)})
+                VALUES %s
+                ON CONFLICT (mongo_id) DO UPDATE SET
+                    course_id = EXCLUDED.course_id,
+                    subject = EXCLUDED.subject,
+                    level = EXCLUDED.level,
+                    stats_average_attendance = EXCLUDED.stats_average_attendance,
+                    stats_average_grade = EXCLUDED.stats_average_grade,
+                    stats_average_behavior = EXCLUDED.stats_average_behavior,
+                    stats_last_updated = EXCLUDED.stats_last_updated,
+                    updated_at = EXCLUDED.updated_at
+                RETURNING id, mongo_id
+            """, session_rows, fetch=True)
+            ids_by_mongo_id = {mongo_id: session_id for session_id, mongo_id in returned}
+            session_ids = {row[0]: ids_by_mongo_id[row[2]] for row in rows['courses_sessions']}
+            rows['courses_sessions'].clear()
+
+        # Remplacer les lignes enfants et retirer les sessions qui ne font plus partie du cours
+        cur.execute("""
+            DELETE FROM education.courses_sessions_timeslot
+            WHERE course_sessions_id IN (
+                SELECT id FROM education.courses_sessions WHERE course_id = %s
+            )
+        """, (course_id,))
+        cur.execute("""
+            DELETE FROM education.courses_sessions_students
+            WHERE course_sessions_id IN (
+                SELECT id FROM education.courses_sessions WHERE course_id = %s
+            )
+        """, (course_id,))
+        # Les sessions retirées encore référencées (notes, comportements...) sont conservées :
+        # les supprimer violerait les clés étrangères et bloquerait le cours à chaque passage
+        references = session_references(cur)
+        not_referenced = ''.join(
+            f" AND NOT EXISTS (SELECT 1 FROM {table} r WHERE r.{column} = s.id)"
+            for table, column in references
+        )
+        cur.execute("""
+            SELECT id FROM education.courses_sessions
+            WHERE course_id = %s
+            AND NOT (id = ANY(%s::uuid[]))
+        """, (course_id, list(session_ids.values())))
+        stale_ids = [row[0] for row in cur.fetchall()]
+        if stale_ids:
+            cur.execute(f"""
+                DELETE FROM education.courses_sessions s
+                WHERE s.id = ANY(%s::uuid[]){not_referenced}
+                RETURNING s.id
+            """, (stale_ids,))
+            kept = set(stale_ids) - {row[0] for row in cur.fetchall()}
+            for session_id in kept:
+                logger.warning(
+                    f"Session {session_id} retirée du cours {mongo_course['_id']} conservée: encore référencée"
+                )
+        cur.execute("""
+            DELETE FROM education.courses_teacher
+            WHERE course_id = %s
+        """, (course_id,))
 
-        updated_count = 0
-        not_found_ids = set()  # Pour stocker les IDs uniques non trouvés
+        rows['courses_teacher'] = [
+            (row[0], course_id) + row[2:] for row in rows['courses_teacher']
+        ]
+        for table in ('courses_sessions_timeslot', 'courses_sessions_students'):
+            rows[table] = [
+                (row[0], session_ids[row[1]]) + row[2:] for row in rows[table]
+            ]
+        insert_course_rows(cur, rows)
 
-        for record in records:
-            record_id, mongo_teacher_id = record
+        pg_conn.commit()
+        logger.info(f"Cours {mongo_course['_id']} synchronisé")
 
-            # Chercher l'ID Supabase correspondant
-            if mongo_teacher_id in id_mapping:
-                supabase_id = id_mapping[mongo_teacher_id]
+    except Exception as e:
+        pg_conn.rollback()
+        logger.error(f"Erreur lors de la synchronisation du cours {mongo_course['_id']}: {str(e)}")
+        raise
+    finally:
+        cur.close()
 
-                # Mettre à jour l'enregistrement
-                cur.execute("""
-                    UPDATE education.courses_teacher
-                    SET teacher_id = %s
-                    WHERE id = %s
-                """, (supabase_id, record_id))
+def sync_courses(pg_conn, db, user_ids=None):
+    """Synchronise uniquement les cours créés ou modifiés depuis le dernier high-water mark"""
+    start = time.perf_counter()
+    last_updated_at, last_mongo_id, pending_mongo_ids = load_watermark(pg_conn, COURSE_WATERMARK)
+
+    # Lire le nouveau high-water mark avant le parcours : un cours modifié pendant
+    # la synchronisation sera simplement repris au passage suivant
+    next_watermark = read_course_watermark(db)
+
+    clauses = []
+    if last_updated_at:
+        clauses.append({'updatedAt': {'$gt': last_updated_at}})
+    if last_mongo_id:
+        clauses.append({'_id': {'$gt': ObjectId(last_mongo_id)}})
+    # Cours en erreur lors des passages précédents
+    if pending_mongo_ids:
+        clauses.append({'_id': {'$in': [ObjectId(mongo_id) for mongo_id in pending_mongo_ids]}})
+    query = {'$or': clauses} if clauses else {}
+    logger.info(
+        f"Synchronisation des cours modifiés depuis updatedAt={last_updated_at}, _id={last_mongo_id} "
+        f"et de {len(pending_mongo_ids)} cours en attente"
+    )
+
+    synced = 0
+    failed = []
+    for mongo_course in stream_collection(db, 'coursenews', COURSE_PROJECTION, query):
+        try:
+            upsert_course(pg_conn, mongo_course, user_ids)
+            synced += 1
+        except Exception:
+            failed.append(str(mongo_course['_id']))
+            continue
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"Synchronisation terminée en {elapsed:.2f}s: {synced} cours synchronisés, {len(failed)} en erreur")
+
+    # Le high-water mark avance toujours : seuls les cours en erreur sont repris au prochain passage,
+    # un cours bloqué ne fait pas rejouer toute la synchronisation
+    if failed:
+        logger.warning(f"{len(failed)} cours en erreur seront repris au prochain passage")
+    save_watermark(pg_conn, COURSE_WATERMARK, *next_watermark, failed)
+    return synced, len(failed)
+
+def verify_course_user_references(pg_conn):
+    """Vérifie que les enseignants et étudiants calculés à l'insertion existent dans education.users"""
+    verify_user_references(pg_conn, 'courses_teacher', 'mongo_teacher_id', 'teacher_id')
+    verify_user_references(pg_conn, 'courses_sessions_students', 'mongo_student_id', 'student_id')
+
+def stage_id_mapping(cur, id_mapping):
+    """Charge le mapping MongoDB -> Supabase dans une table temporaire via un seul COPY"""
+    cur.execute("DROP TABLE IF EXISTS pg_temp.id_mapping_stage")
+    cur.execute("""
+        CREATE TEMP TABLE id_mapping_stage (
+            mongo_id TEXT PRIMARY KEY,
+            supabase_id UUID NOT NULL
+        )
+    """)
+    count = copy_rows(cur, 'id_mapping_stage', ('mongo_id', 'supabase_id'), list(id_mapping.items()))
+    cur.execute("ANALYZE id_mapping_stage")
+    logger.info(f"Mapping chargé dans la table temporaire: {count} entrées")
 
-                updated_count += 1
-            else:
-                not_found_ids.add(mongo_teacher_id)
+def update_teacher_ids(pg_conn, id_mapping):
+    """Met à jour les teacher_id en une seule jointure sur le mapping chargé en table temporaire"""
+    try:
+        cur = pg_conn.cursor()
+        stage_id_mapping(cur, id_mapping)
+
+        # Mettre à jour tous les enregistrements en une seule requête
+        cur.execute("""
+            UPDATE education.courses_teacher ct
+            SET teacher_id = m.supabase_id
+            FROM id_mapping_stage m
+            WHERE ct.mongo_teacher_id = m.mongo_id
+            AND ct.teacher_id IS NULL
+        """)
+        updated_count = cur.rowcount
+
+        # Récupérer les IDs uniques absents du mapping
+        cur.execute("""
+            SELECT DISTINCT ct.mongo_teacher_id
+            FROM education.courses_teacher ct
+            WHERE ct.teacher_id IS NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM id_mapping_stage m
+                WHERE m.mongo_id = ct.mongo_teacher_id
+            )
+        """)
+        not_found_ids = {row[0] for row in cur.fetchall()}
 
         pg_conn.commit()
         logger.info(f"Mise à jour des teacher_id terminée:")
@@ -450,38 +849,32 @@ def update_teacher_ids(pg_conn, id_mapping):
         cur.close()
 
 def update_student_ids(pg_conn, id_mapping):
-    """Met à jour les student_id en utilisant le mapping"""
+    """Met à jour les student_id en une seule jointure sur le mapping chargé en table temporaire"""
     try:
         cur = pg_conn.cursor()
+        stage_id_mapping(cur, id_mapping)
 
-        # Récupérer tous les enregistrements
+        # Mettre à jour tous les enregistrements en une seule requête
         cur.execute("""
-            SELECT id, mongo_student_id
-            FROM education.courses_sessions_students
-            WHERE student_id IS NULL
+            UPDATE education.courses_sessions_students css
+            SET student_id = m.supabase_id
+            FROM id_mapping_stage m
+            WHERE css.mongo_student_id = m.mongo_id
+            AND css.student_id IS NULL
         """)
-        records = cur.fetchall()
-
-        updated_count = 0
-        not_found_ids = set()  # Pour stocker les IDs uniques non trouvés
-
-        for record in records:
-            record_id, mongo_student_id = record
-
-            # Chercher l'ID Supabase correspondant
-            if mongo_student_id in id_mapping:
-                supabase_id = id_mapping[mongo_student_id]
+        updated_count = cur.rowcount
 
-                # Mettre à jour l'enregistrement
-                cur.execute("""
-                    UPDATE education.courses_sessions_students
-                    SET student_id = %s
-                    WHERE id = %s
-                """, (supabase_id, record_id))
-
-                updated_count += 1
-            else:
-                not_found_ids.add(mongo_student_id)
+        # Récupérer les IDs uniques absents du mapping
+        cur.execute("""
+            SELECT DISTINCT css.mongo_student_id
+            FROM education.courses_sessions_students css
+            WHERE css.student_id IS NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM id_mapping_stage m
+                WHERE m.mongo_id = css.mongo_student_id
+            )
+        """)
+        not_found_ids = {row[0] for row in cur.fetchall()}
 
         pg_conn.commit()
         logger.info(f"Mise à jour des student_id terminée:")
@@ -500,122 +893,132 @@ def update_student_ids(pg_conn, id_mapping):
         cur.close()
 
 def verify_migration(pg_conn, mongo_db):
-    """Vérifie que la migration s'est bien passée"""
+    """Vérifie la migration en lisant chaque table une seule fois et en comparant des index en mémoire"""
     try:
         cur = pg_conn.cursor()
+        start = time.perf_counter()
+        errors = 0
 
-        # Récupérer tous les cours migrés
+        # Vérifier d'abord que la collection existe
+        collection_names = mongo_db.list_collection_names()
+        logger.info(f"Collections MongoDB disponibles: {collection_names}")
+
+        if 'coursenews' not in collection_names:
+            raise ValueError("La collection 'coursenews' n'existe pas dans MongoDB")
+
+        # Charger chaque table Supabase en une seule requête
         cur.execute("""
             SELECT id, mongo_id, academic_year, is_active
             FROM education.courses
         """)
         migrated_courses = cur.fetchall()
-
         logger.info(f"Vérification de {len(migrated_courses)} cours migrés...")
 
-        # Vérifier d'abord que la collection existe et contient des données
-        collection_names = mongo_db.list_collection_names()
-        logger.info(f"Collections MongoDB disponibles: {collection_names}")
-
-        if 'coursenews' not in collection_names:
-            raise ValueError("La collection 'coursenews' n'existe pas dans MongoDB")
+        cur.execute("""
+            SELECT course_id, mongo_teacher_id
+            FROM education.courses_teacher
+        """)
+        teachers_by_course = defaultdict(set)
+        for course_id, mongo_teacher_id in cur.fetchall():
+            teachers_by_course[course_id].add(mongo_teacher_id)
 
-        # Compter le nombre de documents dans la collection
-        count = mongo_db.coursenews.count_documents({})
-        logger.info(f"Nombre de documents dans la collection coursenews: {count}")
+        cur.execute("""
+            SELECT id, course_id, course_session_mongo_id, subject, level
+            FROM education.courses_sessions
+        """)
+        sessions_by_course = defaultdict(list)
+        for session in cur.fetchall():
+            sessions_by_course[session[1]].append(session)
 
-        for course in migrated_courses:
-            supabase_id, mongo_id, academic_year, is_active = course
-            logger.info(f"Vérification du cours {mongo_id}...")
+        cur.execute("""
+            SELECT course_sessions_id, day_of_week, classroom_number
+            FROM education.courses_sessions_timeslot
+        """)
+        timeslot_by_session = {}
+        for session_id, day_of_week, classroom_number in cur.fetchall():
+            timeslot_by_session.setdefault(session_id, (day_of_week, classroom_number))
 
-            # Récupérer le cours MongoDB
-            mongo_course = mongo_db.coursenews.find_one({'_id': ObjectId(mongo_id)})
+        cur.execute("""
+            SELECT course_sessions_id, mongo_student_id
+            FROM education.courses_sessions_students
+        """)
+        students_by_session = defaultdict(set)
+        for session_id, mongo_student_id in cur.fetchall():
+            students_by_session[session_id].add(mongo_student_id)
+
+        # Lire coursenews une seule fois, indexé par mongo_id
+        mongo_courses = {
+            str(course['_id']): course
+            for course in stream_collection(
+                mongo_db,
+                'coursenews',
+                {'academicYear': 1, 'isActive': 1, 'teacher': 1, 'sessions': 1}
+            )
+        }
+        logger.info(f"Nombre de documents dans la collection coursenews: {len(mongo_courses)}")
+
+        for supabase_id, mongo_id, academic_year, is_active in migrated_courses:
+            mongo_course = mongo_courses.get(mongo_id)
             if not mongo_course:
                 logger.error(f"Cours MongoDB {mongo_id} non trouvé")
-                # Afficher quelques documents de la collection pour debug
-                sample = list(mongo_db.coursenews.find().limit(1))
-                if sample:
-                    logger.info(f"Exemple de document dans la collection: {sample[0]}")
+                errors += 1
                 continue
 
             # Vérifier les champs de base
             if str(mongo_course.get('academicYear')) != str(academic_year):
                 logger.error(f"Différence d'année académique pour le cours {mongo_id}")
+                errors += 1
             if mongo_course.get('isActive') != is_active:
                 logger.error(f"Différence de statut actif pour le cours {mongo_id}")
+                errors += 1
 
             # Vérifier les enseignants
-            cur.execute("""
-                SELECT mongo_teacher_id, teacher_id
-                FROM education.courses_teacher
-                WHERE course_id = %s
-            """, (supabase_id,))
-            supabase_teachers = cur.fetchall()
-
-            mongo_teachers = [str(t) for t in mongo_course.get('teacher', [])]
-            supabase_teacher_ids = [t[0] for t in supabase_teachers]
-
-            if set(mongo_teachers) != set(supabase_teacher_ids):
+            mongo_teachers = {str(t) for t in mongo_course.get('teacher', [])}
+            if mongo_teachers != teachers_by_course[supabase_id]:
                 logger.error(f"Différence dans les enseignants pour le cours {mongo_id}")
+                errors += 1
 
             # Vérifier les sessions
-            cur.execute("""
-                SELECT id, mongo_id, course_session_mongo_id, subject, level
-                FROM education.courses_sessions
-                WHERE course_id = %s
-            """, (supabase_id,))
-            supabase_sessions = cur.fetchall()
-
             mongo_sessions = {str(s['_id']): s for s in mongo_course.get('sessions', [])}
 
-            for session in supabase_sessions:
-                supabase_session_id, mongo_id, course_session_mongo_id, subject, level = session
-
-                if course_session_mongo_id not in mongo_sessions:
+            for session_id, _, course_session_mongo_id, subject, level in sessions_by_course[supabase_id]:
+                mongo_session = mongo_sessions.get(course_session_mongo_id)
+                if mongo_session is None:
                     logger.error(f"Session {course_session_mongo_id} non trouvée dans MongoDB")
+                    errors += 1
                     continue
 
-                mongo_session = mongo_sessions[course_session_mongo_id]
-
                 # Vérifier les champs de la session
                 if mongo_session.get('subject') != subject:
                     logger.error(f"Différence de sujet pour la session {course_session_mongo_id}")
+                    errors += 1
                 if mongo_session.get('level') != level:
                     logger.error(f"Différence de niveau pour la session {course_session_mongo_id}")
+                    errors += 1
 
                 # Vérifier les créneaux horaires
-                cur.execute("""
-                    SELECT day_of_week, start_time, end_time, classroom_number
-                    FROM education.courses_sessions_timeslot
-                    WHERE course_sessions_id = %s
-                """, (supabase_session_id,))
-                supabase_timeslot = cur.fetchone()
-
+                supabase_timeslot = timeslot_by_session.get(session_id)
                 mongo_timeslot = mongo_session.get('timeSlot', {})
 
                 if supabase_timeslot:
-                    day_of_week, start_time, end_time, classroom_number = supabase_timeslot
+                    day_of_week, classroom_number = supabase_timeslot
 
                     if mongo_timeslot.get('dayOfWeek') != day_of_week:
                         logger.error(f"Différence de jour pour la session {course_session_mongo_id}")
+                        errors += 1
                     if str(mongo_timeslot.get('classroomNumber')) != str(classroom_number):
                         logger.error(f"Différence de salle pour la session {course_session_mongo_id}")
+                        errors += 1
 
                 # Vérifier les étudiants
-                cur.execute("""
-                    SELECT mongo_student_id, student_id
-                    FROM education.courses_sessions_students
-                    WHERE course_sessions_id = %s
-                """, (supabase_session_id,))
-                supabase_students = cur.fetchall()
-
-                mongo_students = [str(s) for s in mongo_session.get('students', [])]
-                supabase_student_ids = [s[0] for s in supabase_students]
-
-                if set(mongo_students) != set(supabase_student_ids):
+                mongo_students = {str(s) for s in mongo_session.get('students', [])}
+                if mongo_students != students_by_session[session_id]:
                     logger.error(f"Différence dans les étudiants pour la session {course_session_mongo_id}")
+                    errors += 1
 
-        logger.info("Vérification terminée")
+        elapsed = time.perf_counter() - start
+        logger.info(f"Vérification terminée en {elapsed:.2f}s: {errors} différences trouvées")
+        return errors
 
     except Exception as e:
         logger.error(f"Erreur lors de la vérification: {str(e)}")
@@ -623,7 +1026,55 @@ def verify_migration(pg_conn, mongo_db):
     finally:
         cur.close()
 
+def parse_args():
+    """Analyse les arguments de la ligne de commande"""
+    parser = argparse.ArgumentParser(description="Migration des cours de MongoDB vers Supabase")
+    parser.add_argument(
+        '--bulk',
+        action='store_true',
+        help="Charge le graphe des cours via COPY FROM STDIN au lieu d'un INSERT par ligne"
+    )
+    parser.add_argument(
+        '--chunk-size',
+        type=int,
+        default=COPY_CHUNK_SIZE,
+        help=f"Nombre de cours par lot COPY (défaut: {COPY_CHUNK_SIZE})"
+    )
+    parser.add_argument(
+        '--verify-only',
+        action='store_true',
+        help="Lance uniquement la vérification rapide de la migration existante"
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help="Reprend une migration interrompue sans supprimer les tables, en ignorant les documents déjà migrés"
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help="Nombre de shards migrés en parallèle, chacun sur sa connexion (ignoré avec --bulk)"
+    )
+    parser.add_argument(
+        '--defer-constraints',
+        action='store_true',
+        help="Crée des tables nues et ajoute clés et index après le chargement (à combiner avec --bulk)"
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help="Synchronise uniquement les cours modifiés depuis le dernier passage, sans supprimer les tables"
+    )
+    parser.add_argument(
+        '--computed-ids',
+        action='store_true',
+        help="Calcule teacher_id et student_id depuis les ObjectId à l'insertion, sans passe de mise à jour"
+    )
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
     try:
         # Connexion à MongoDB
         logger.info("Connexion à MongoDB...")
@@ -633,40 +1084,93 @@ def main():
         logger.info("Connexion à Supabase...")
         pg_conn = connect_supabase()
 
-        # Supprimer les tables existantes
-        logger.info("Suppression des tables existantes...")
-        drop_tables(pg_conn)
+        if args.verify_only:
+            logger.info("Vérification de la migration...")
+            verify_migration(pg_conn, db)
+            return
+
+        # UUID des utilisateurs existants, pour calculer les références à l'insertion
+        user_ids = load_user_ids(pg_conn) if args.computed_ids else None
+
+        if args.incremental:
+            logger.info("Synchronisation incrémentale des cours...")
+            sync_courses(pg_conn, db, user_ids)
+
+            # Résoudre les IDs des nouvelles lignes enseignants et étudiants
+            if args.computed_ids:
+                verify_course_user_references(pg_conn)
+            else:
+                with load_id_mapping() as id_mapping:
+                    update_teacher_ids(pg_conn, id_mapping)
+                    update_student_ids(pg_conn, id_mapping)
+
+            logger.info("Synchronisation terminée avec succès !")
+            return
+
+        # High-water mark lu avant le chargement complet, enregistré une fois celui-ci terminé
+        watermark = read_course_watermark(db)
+
+        # Supprimer les tables existantes (conservées en mode reprise)
+        if not args.resume:
+            logger.info("Suppression des tables existantes...")
+            drop_tables(pg_conn)
 
         # Créer les nouvelles tables
         logger.info("Création des nouvelles tables...")
-        create_tables(pg_conn)
+        create_tables(pg_conn, defer_constraints=args.defer_constraints)
 
         # Récupérer tous les cours de MongoDB
         logger.info("Récupération des cours depuis MongoDB...")
         mongo_courses = get_mongo_courses(db)
 
-        # Migrer chaque cours
-        logger.info(f"Début de la migration de {len(mongo_courses)} cours...")
-        for i, course in enumerate(mongo_courses, 1):
-            logger.info(f"Migration du cours {i}/{len(mongo_courses)} (ID: {course['_id']})")
-            migrate_course(pg_conn, course)
-
-        # Charger le mapping des IDs
-        logger.info("Chargement du mapping des IDs...")
-        id_mapping = load_id_mapping()
+        # En mode reprise, écarter en amont les cours déjà migrés
+        existing_ids = None
+        if args.resume:
+            existing_ids = load_existing_mongo_ids(pg_conn, 'education.courses')
+            mongo_courses = skip_existing(mongo_courses, pg_conn, 'education.courses', existing_ids)
 
-        # Mettre à jour les IDs des enseignants
-        logger.info("Mise à jour des IDs des enseignants...")
-        update_teacher_ids(pg_conn, id_mapping)
+        # Pas de vérification par document en reprise (déjà filtrés) ni sans index unique sur mongo_id
+        check_existing = not args.resume and not args.defer_constraints
 
-        # Mettre à jour les IDs des étudiants
-        logger.info("Mise à jour des IDs des étudiants...")
-        update_student_ids(pg_conn, id_mapping)
+        # Migrer chaque cours
+        logger.info("Début de la migration des cours...")
+        if args.bulk:
+            bulk_load_courses(pg_conn, mongo_courses, args.chunk_size, user_ids)
+        elif args.workers > 1:
+            migrate_courses_parallel(db, args.workers, existing_ids, user_ids, check_existing)
+        else:
+            for i, course in enumerate(mongo_courses, 1):
+                logger.info(f"Migration du cours {i} (ID: {course['_id']})")
+                migrate_course(pg_conn, course, check_existing=check_existing, user_ids=user_ids)
+
+        # Ajouter les contraintes différées une fois les données chargées
+        if args.defer_constraints:
+            logger.info("Ajout des contraintes différées...")
+            add_constraints(pg_conn, COURSE_CONSTRAINTS)
+
+        if args.computed_ids:
+            # Les IDs ont été calculés à l'insertion : une seule jointure de vérification
+            logger.info("Vérification des références enseignants et étudiants...")
+            verify_course_user_references(pg_conn)
+        else:
+            # Charger le mapping des IDs
+            logger.info("Chargement du mapping des IDs...")
+            with load_id_mapping() as id_mapping:
+                # Mettre à jour les IDs des enseignants
+                logger.info("Mise à jour des IDs des enseignants...")
+                update_teacher_ids(pg_conn, id_mapping)
+
+                # Mettre à jour les IDs des étudiants
+                logger.info("Mise à jour des IDs des étudiants...")
+                update_student_ids(pg_conn, id_mapping)
 
         # Vérifier la migration
         logger.info("Vérification de la migration...")
         verify_migration(pg_conn, db)
 
+        # Point de départ des prochaines synchronisations incrémentales
+        save_watermark(pg_conn, COURSE_WATERMARK, *watermark)
+
         logger.info("Migration terminée avec succès !")
 
     except Exception as e:
@@ -2,11 +2,11 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
-import json
 import logging
 from datetime import datetime
 import psycopg2
 import traceback
+from id_map_store import open_id_map
 
 # Configuration du logging
 logging.basicConfig(
@@ -35,25 +35,17 @@ def connect_supabase():
         raise
 
 def load_id_mapping():
-    """Charge le mapping des IDs depuis le fichier JSON"""
+    """Ouvre le mapping binaire des IDs partagé (régénéré depuis le JSON si besoin)"""
     try:
-        with open('./mongo_to_supabase_ids.json', 'r') as f:
-            data = json.load(f)
-
-        # Créer un mapping direct mongo_id -> supabase_id
-        mapping = {}
-        for user_data in data.values():
-            mongo_id = user_data.get('mongo_id')
-            supabase_id = user_data.get('supabase_id')
-            if mongo_id and supabase_id:
-                mapping[mongo_id] = supabase_id
+        mapping = open_id_map()
 
         logger.info(f"Mapping chargé: {len(mapping)} entrées")
         # Afficher quelques exemples pour debug
         logger.info("Exemples de mapping:")
         for i, (mongo_id, supabase_id) in enumerate(mapping.items()):
-            if i < 3:  # Afficher les 3 premiers
-                logger.info(f"MongoDB: {mongo_id} -> Supabase: {supabase_id}")
+            if i >= 3:  # Afficher les 3 premiers
+                break
+            logger.info(f"MongoDB: {mongo_id} -> Supabase: {supabase_id}")
         return mapping
     except Exception as e:
         logger.error(f"Erreur lors du chargement du mapping: {str(e)}")
@@ -156,6 +148,8 @@ def main():
         logger.error(f"Erreur lors de l'exécution: {str(e)}")
         logger.error(f"Traceback complet: {traceback.format_exc()}")
     finally:
+        if 'id_mapping' in locals():
+            id_mapping.close()
         if 'pg_conn' in locals():
             pg_conn.close()
 
@@ -3,13 +3,20 @@ load_dotenv()
 
 import os
 import json
+import time
+import argparse
 import logging
 from datetime import datetime
+from functools import lru_cache
 from pymongo import MongoClient
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_values
 import uuid
 import traceback
+from mongo_stream import iter_chunks, stream_collection
+from pg_constraints import add_constraints
+from mongo_id_index import load_existing_mongo_ids, skip_existing
+from user_uuid import load_user_ids, resolve_user_ids, verify_user_references
 
 # Configuration du logging
 logging.basicConfig(
@@ -22,6 +29,75 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Nombre de notes insérées par transaction en mode batch
+GRADE_BATCH_SIZE = 200
+
+# Taille du cache LRU des sessions (0 : mapping complet préchargé au démarrage)
+SESSION_CACHE_SIZE = 0
+
+# Champs MongoDB lus par la migration des notes
+GRADE_PROJECTION = {
+    'sessionId': 1,
+    'date': 1,
+    'type': 1,
+    'isDraft': 1,
+    'stats': 1,
+    'records': 1,
+    'createdAt': 1,
+    'updatedAt': 1
+}
+
+# Contraintes des tables temporaires des notes, dans l'ordre où elles peuvent être ajoutées :
+# clés primaires, index uniques, puis clés étrangères
+GRADE_CONSTRAINTS = [
+    ('tmp_grades_pkey', 'tmp_grades', 'PRIMARY KEY (id)'),
+    ('tmp_grades_records_pkey', 'tmp_grades_records', 'PRIMARY KEY (id)'),
+    ('tmp_grades_teachers_migration_pkey', 'tmp_grades_teachers_migration', 'PRIMARY KEY (id)'),
+    ('tmp_grades_mongo_id_key', 'tmp_grades', 'UNIQUE (mongo_id)'),
+    ('tmp_grades_course_session_id_fkey', 'tmp_grades',
+     'FOREIGN KEY (course_session_id) REFERENCES education.courses_sessions(id)'),
+    ('tmp_grades_records_grade_id_fkey', 'tmp_grades_records',
+     'FOREIGN KEY (grade_id) REFERENCES education.tmp_grades(id)'),
+    ('tmp_grades_records_student_id_fkey', 'tmp_grades_records',
+     'FOREIGN KEY (student_id) REFERENCES education.users(id)'),
+    ('tmp_grades_teachers_migration_course_session_id_fkey', 'tmp_grades_teachers_migration',
+     'FOREIGN KEY (course_session_id) REFERENCES education.courses_sessions(id)'),
+    ('tmp_grades_teachers_migration_teacher_id_fkey', 'tmp_grades_teachers_migration',
+     'FOREIGN KEY (teacher_id) REFERENCES education.users(id)'),
+]
+
+# Tables temporaires et tables de production qu'elles remplacent, parents en premier
+PROMOTED_TABLES = [
+    ('tmp_grades', 'grades'),
+    ('tmp_grades_records', 'grades_records'),
+    ('tmp_grades_teachers_migration', 'grades_teachers_migration'),
+]
+
+# Suffixe des anciennes tables de production conservées après la bascule
+PROMOTION_BACKUP_SUFFIX = '_old'
+
+# Attente maximale des verrous lors de la bascule, pour ne pas bloquer l'application
+PROMOTION_LOCK_TIMEOUT = '5s'
+
+# Colonnes insérées pour chaque table des notes,
+# dans l'ordre de chargement imposé par les clés étrangères
+GRADE_TABLE_COLUMNS = {
+    'tmp_grades': (
+        'id', 'mongo_id', 'course_session_id', 'date', 'type', 'is_draft',
+        'stats_average_grade', 'stats_highest_grade', 'stats_lowest_grade',
+        'stats_absent_count', 'stats_total_students', 'last_update',
+        'created_at', 'updated_at', 'is_active'
+    ),
+    'tmp_grades_records': (
+        'id', 'grade_id', 'mongo_student_id', 'value', 'is_absent', 'comment',
+        'created_at', 'updated_at', 'student_id'
+    ),
+    'tmp_grades_teachers_migration': (
+        'id', 'course_session_id', 'mongo_teacher_id', 'original_grade',
+        'created_at', 'updated_at', 'teacher_id'
+    ),
+}
+
 def connect_mongodb():
     """Connexion à MongoDB"""
     try:
@@ -78,17 +154,18 @@ def drop_tmp_tables(pg_conn):
     finally:
         cur.close()
 
-def create_tmp_tables(pg_conn):
-    """Crée les tables temporaires dans Supabase"""
+def create_tmp_tables(pg_conn, defer_constraints=False):
+    """Crée les tables temporaires dans Supabase, avec leurs contraintes sauf si elles sont différées"""
     try:
         cur = pg_conn.cursor()
+        start = time.perf_counter()
 
         # Table des notes
         cur.execute("""
             CREATE TABLE IF NOT EXISTS education.tmp_grades (
-                id UUID PRIMARY KEY,
-                mongo_id TEXT NOT NULL UNIQUE,
-                course_session_id UUID REFERENCES education.courses_sessions(id),
+                id UUID NOT NULL,
+                mongo_id TEXT NOT NULL,
+                course_session_id UUID,
                 date TIMESTAMP WITH TIME ZONE NOT NULL,
                 type TEXT NOT NULL,
                 is_draft BOOLEAN DEFAULT false,
@@ -108,10 +185,10 @@ def create_tmp_tables(pg_conn):
         # Table des notes des étudiants
         cur.execute("""
             CREATE TABLE IF NOT EXISTS education.tmp_grades_records (
-                id UUID PRIMARY KEY,
-                grade_id UUID REFERENCES education.tmp_grades(id),
+                id UUID NOT NULL,
+                grade_id UUID,
                 mongo_student_id TEXT NOT NULL,
-                student_id UUID REFERENCES education.users(id),
+                student_id UUID,
                 value DECIMAL,
                 is_absent BOOLEAN DEFAULT false,
                 comment TEXT,
@@ -123,10 +200,10 @@ def create_tmp_tables(pg_conn):
         # Table de migration des enseignants
         cur.execute("""
             CREATE TABLE IF NOT EXISTS education.tmp_grades_teachers_migration (
-                id UUID PRIMARY KEY,
-                course_session_id UUID REFERENCES education.courses_sessions(id),
+                id UUID NOT NULL,
+                course_session_id UUID,
                 mongo_teacher_id TEXT NOT NULL,
-                teacher_id UUID REFERENCES education.users(id),
+                teacher_id UUID,
                 original_grade TEXT NOT NULL,
                 created_at TIMESTAMP WITH TIME ZONE,
                 updated_at TIMESTAMP WITH TIME ZONE
@@ -134,7 +211,7 @@ def create_tmp_tables(pg_conn):
         """)
 
         pg_conn.commit()
-        logger.info("Tables temporaires créées avec succès")
+        logger.info(f"Tables temporaires créées avec succès en {time.perf_counter() - start:.2f}s")
 
     except Exception as e:
         pg_conn.rollback()
@@ -143,180 +220,245 @@ def create_tmp_tables(pg_conn):
     finally:
         cur.close()
 
+    if defer_constraints:
+        logger.info("Contraintes différées: elles seront ajoutées après le chargement")
+    else:
+        add_constraints(pg_conn, GRADE_CONSTRAINTS)
+
 def get_mongo_grades(db):
-    """Récupère toutes les notes depuis MongoDB"""
+    """Renvoie un itérateur en streaming sur les notes MongoDB"""
     try:
         # Vérifier que la collection existe
         if 'gradenews' not in db.list_collection_names():
             raise ValueError("La collection 'gradenews' n'existe pas dans MongoDB")
 
-        grades = list(db.gradenews.find())
-        if not grades:
+        count = db.gradenews.estimated_document_count()
+        if not count:
             logger.warning("Aucune note trouvée dans MongoDB")
-            return []
 
-        logger.info(f"Nombre de notes trouvées dans MongoDB: {len(grades)}")
-        return grades
+        logger.info(f"Nombre de notes trouvées dans MongoDB: {count}")
+        return stream_collection(db, 'gradenews', GRADE_PROJECTION)
     except Exception as e:
         logger.error(f"Erreur lors de la récupération des notes MongoDB: {str(e)}")
         raise
 
-def migrate_grade(pg_conn, mongo_grade):
+def load_session_map(pg_conn):
+    """Charge une seule fois le mapping mongo_id -> UUID des sessions de cours"""
+    cur = pg_conn.cursor()
+    try:
+        cur.execute("SELECT mongo_id, id FROM education.courses_sessions")
+        sessions = dict(cur.fetchall())
+        logger.info(f"Sessions de cours préchargées: {len(sessions)}")
+        return sessions
+    finally:
+        cur.close()
+
+def make_session_lookup(pg_conn, cache_size=SESSION_CACHE_SIZE):
+    """Renvoie une fonction mongo_id -> UUID de session, préchargée ou avec un cache LRU borné"""
+    if not cache_size:
+        return load_session_map(pg_conn).get
+
+    @lru_cache(maxsize=cache_size)
+    def lookup(mongo_session_id):
+        cur = pg_conn.cursor()
+        try:
+            cur.execute("""
+                SELECT id FROM education.courses_sessions
+                WHERE mongo_id = %s
+            """, (mongo_session_id,))
+            result = cur.fetchone()
+            return result[0] if result else None
+        finally:
+            cur.close()
+
+    logger.info(f"Sessions de cours résolues à la demande (cache LRU de {cache_size} entrées)")
+    return lookup
+
+def build_grade_rows(mongo_grade, course_session_id, user_ids=None):
+    """Construit en mémoire les lignes d'une note et de ses enfants, avec des UUID générés côté Python.
+
+    Si user_ids (UUID des utilisateurs existants) est fourni, student_id et teacher_id
+    sont calculés à partir des ObjectId au lieu de rester à NULL.
+    """
+    rows = {table: [] for table in GRADE_TABLE_COLUMNS}
+    now = datetime.now()
+    grade_id = str(uuid.uuid4())
+    stats = mongo_grade.get('stats', {})
+
+    rows['tmp_grades'].append((
+        grade_id,
+        str(mongo_grade['_id']),
+        course_session_id,
+        mongo_grade.get('date'),
+        mongo_grade.get('type'),
+        mongo_grade.get('isDraft', False),
+        stats.get('averageGrade'),
+        stats.get('highestGrade'),
+        stats.get('lowestGrade'),
+        stats.get('absentCount'),
+        stats.get('totalStudents'),
+        now,
+        mongo_grade.get('createdAt', now),
+        mongo_grade.get('updatedAt', now),
+        True
+    ))
+
+    records = []
+    for record in mongo_grade.get('records', []):
+        if not record.get('student'):
+            logger.warning(f"ID étudiant vide trouvé dans la note {mongo_grade['_id']}")
+            continue
+        records.append(record)
+
+    student_uuids = (
+        resolve_user_ids([record['student'] for record in records], user_ids)
+        if user_ids is not None else [None] * len(records)
+    )
+    for record, student_uuid in zip(records, student_uuids):
+        rows['tmp_grades_records'].append((
+            str(uuid.uuid4()),
+            grade_id,
+            str(record['student']),
+            record.get('value'),
+            record.get('isAbsent', False),
+            record.get('comment'),
+            now,
+            now,
+            student_uuid
+        ))
+
+        # Contexte de migration si présent dans le record
+        context = record.get('migrationContext')
+        if context and context.get('originalTeacher'):
+            teacher_uuid = (
+                resolve_user_ids([context['originalTeacher']], user_ids)[0]
+                if user_ids is not None else None
+            )
+            rows['tmp_grades_teachers_migration'].append((
+                str(uuid.uuid4()),
+                course_session_id,
+                str(context['originalTeacher']),
+                str(mongo_grade['_id']),
+                now,
+                now,
+                teacher_uuid
+            ))
+
+    return rows
+
+def insert_grade_rows(cur, rows):
+    """Insère les lignes des notes avec un INSERT multi-lignes par table"""
+    for table, columns in GRADE_TABLE_COLUMNS.items():
+        if rows[table]:
+            execute_values(
+                cur,
+                f"INSERT INTO education.{table} ({', '.join(columns)}) VALUES %s",
+                rows[table]
+            )
+
+def migrate_grade(pg_conn, mongo_grade, check_existing=True, user_ids=None, session_lookup=None):
     """Migre une note de MongoDB vers Supabase"""
     try:
         cur = pg_conn.cursor()
 
-        # Vérifier que la note n'existe pas déjà
-        cur.execute("""
-            SELECT id FROM education.tmp_grades
-            WHERE mongo_id = %s
-        """, (str(mongo_grade['_id']),))
+        # Vérifier que la note n'existe pas déjà (déjà filtré en amont en mode reprise)
+        if check_existing:
+            cur.execute("""
+                SELECT id FROM education.tmp_grades
+                WHERE mongo_id = %s
+            """, (str(mongo_grade['_id']),))
 
-        if cur.fetchone():
-            logger.warning(f"La note {mongo_grade['_id']} existe déjà dans Supabase, elle sera ignorée")
-            return
+            if cur.fetchone():
+                logger.warning(f"La note {mongo_grade['_id']} existe déjà dans Supabase, elle sera ignorée")
+                return
 
         # Vérifier les champs obligatoires
         if 'sessionId' not in mongo_grade:
             logger.warning(f"La note {mongo_grade['_id']} n'a pas de session associée, elle sera ignorée")
             return
 
-        # Récupérer l'ID de la session du cours
-        cur.execute("""
-            SELECT id FROM education.courses_sessions
-            WHERE mongo_id = %s
-        """, (str(mongo_grade['sessionId']),))
+        # Récupérer l'ID de la session du cours, depuis le cache si disponible
+        if session_lookup:
+            course_session_id = session_lookup(str(mongo_grade['sessionId']))
+        else:
+            cur.execute("""
+                SELECT id FROM education.courses_sessions
+                WHERE mongo_id = %s
+            """, (str(mongo_grade['sessionId']),))
+            session_result = cur.fetchone()
+            course_session_id = session_result[0] if session_result else None
 
-        session_result = cur.fetchone()
-        if not session_result:
+        if not course_session_id:
             logger.warning(f"La session {mongo_grade['sessionId']} n'existe pas dans Supabase, la note sera ignorée")
             return
 
-        course_session_id = session_result[0]
+        # Construire la note et ses enfants avec des UUID générés côté Python,
+        # puis les insérer avec un INSERT multi-lignes par table
+        rows = build_grade_rows(mongo_grade, course_session_id, user_ids)
+        insert_grade_rows(cur, rows)
 
-        # Insérer la note
-        cur.execute("""
-            INSERT INTO education.tmp_grades (
-                id,
-                mongo_id,
-                course_session_id,
-                date,
-                type,
-                is_draft,
-                stats_average_grade,
-                stats_highest_grade,
-                stats_lowest_grade,
-                stats_absent_count,
-                stats_total_students,
-                last_update,
-                created_at,
-                updated_at,
-                is_active
-            ) VALUES (
-                gen_random_uuid(),
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                %s,
-                true
-            ) RETURNING id
-        """, (
-            str(mongo_grade['_id']),
-            course_session_id,
-            mongo_grade.get('date'),
-            mongo_grade.get('type'),
-            mongo_grade.get('isDraft', False),
-            mongo_grade.get('stats', {}).get('averageGrade'),
-            mongo_grade.get('stats', {}).get('highestGrade'),
-            mongo_grade.get('stats', {}).get('lowestGrade'),
-            mongo_grade.get('stats', {}).get('absentCount'),
-            mongo_grade.get('stats', {}).get('totalStudents'),
-            datetime.now(),
-            mongo_grade.get('createdAt', datetime.now()),
-            mongo_grade.get('updatedAt', datetime.now())
-        ))
-        grade_id = cur.fetchone()[0]
+        pg_conn.commit()
+        logger.info(f"Note {mongo_grade['_id']} migrée avec succès")
 
-        # Insérer les notes des étudiants
-        for record in mongo_grade.get('records', []):
-            if not record.get('student'):
-                logger.warning(f"ID étudiant vide trouvé dans la note {mongo_grade['_id']}")
-                continue
+    except Exception as e:
+        pg_conn.rollback()
+        logger.error(f"Erreur lors de la migration de la note {mongo_grade['_id']}: {str(e)}")
+        logger.error(traceback.format_exc())
+        raise
+    finally:
+        cur.close()
+
+def migrate_grades_batch(pg_conn, mongo_grades, user_ids=None, session_lookup=None, check_existing=True):
+    """Migre un lot de notes en une seule transaction, sans aller-retour entre parents et enfants"""
+    try:
+        cur = pg_conn.cursor()
+        grade_ids = [str(g['_id']) for g in mongo_grades]
+        session_mongo_ids = list({str(g['sessionId']) for g in mongo_grades if 'sessionId' in g})
 
+        # Notes déjà migrées et sessions du lot, en une requête chacune
+        existing_ids = set()
+        if check_existing:
             cur.execute("""
-                INSERT INTO education.tmp_grades_records (
-                    id,
-                    grade_id,
-                    mongo_student_id,
-                    value,
-                    is_absent,
-                    comment,
-                    created_at,
-                    updated_at
-                ) VALUES (
-                    gen_random_uuid(),
-                    %s,
-                    %s,
-                    %s,
-                    %s,
-                    %s,
-                    %s,
-                    %s
-                )
-            """, (
-                grade_id,
-                str(record['student']),
-                record.get('value'),
-                record.get('isAbsent', False),
-                record.get('comment'),
-                datetime.now(),
-                datetime.now()
-            ))
+                SELECT mongo_id FROM education.tmp_grades
+                WHERE mongo_id = ANY(%s)
+            """, (grade_ids,))
+            existing_ids = {row[0] for row in cur.fetchall()}
+
+        if session_lookup:
+            sessions = {sid: session_lookup(sid) for sid in session_mongo_ids}
+        else:
+            cur.execute("""
+                SELECT mongo_id, id FROM education.courses_sessions
+                WHERE mongo_id = ANY(%s)
+            """, (session_mongo_ids,))
+            sessions = dict(cur.fetchall())
+
+        rows = {table: [] for table in GRADE_TABLE_COLUMNS}
+        migrated = 0
+        for mongo_grade in mongo_grades:
+            if str(mongo_grade['_id']) in existing_ids:
+                logger.warning(f"La note {mongo_grade['_id']} existe déjà dans Supabase, elle sera ignorée")
+                continue
+            if 'sessionId' not in mongo_grade:
+                logger.warning(f"La note {mongo_grade['_id']} n'a pas de session associée, elle sera ignorée")
+                continue
+            course_session_id = sessions.get(str(mongo_grade['sessionId']))
+            if not course_session_id:
+                logger.warning(f"La session {mongo_grade['sessionId']} n'existe pas dans Supabase, la note sera ignorée")
+                continue
 
-            # Insérer le contexte de migration si présent dans le record
-            if record.get('migrationContext'):
-                context = record['migrationContext']
-                if context and context.get('originalTeacher'):
-                    cur.execute("""
-                        INSERT INTO education.tmp_grades_teachers_migration (
-                            id,
-                            course_session_id,
-                            mongo_teacher_id,
-                            original_grade,
-                            created_at,
-                            updated_at
-                        ) VALUES (
-                            gen_random_uuid(),
-                            %s,
-                            %s,
-                            %s,
-                            %s,
-                            %s
-                        )
-                    """, (
-                        course_session_id,
-                        str(context['originalTeacher']),
-                        str(mongo_grade['_id']),
-                        datetime.now(),
-                        datetime.now()
-                    ))
+            for table, grade_rows in build_grade_rows(mongo_grade, course_session_id, user_ids).items():
+                rows[table].extend(grade_rows)
+            migrated += 1
 
+        insert_grade_rows(cur, rows)
         pg_conn.commit()
-        logger.info(f"Note {mongo_grade['_id']} migrée avec succès")
+        logger.info(f"Lot de {migrated} notes migré avec succès")
+        return migrated
 
     except Exception as e:
         pg_conn.rollback()
-        logger.error(f"Erreur lors de la migration de la note {mongo_grade['_id']}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.error(f"Erreur lors de la migration du lot de notes: {str(e)}")
         raise
     finally:
         cur.close()
@@ -325,42 +467,43 @@ def verify_migration(pg_conn, mongo_db):
     """Vérifie que la migration s'est bien passée"""
     try:
         cur = pg_conn.cursor()
-        mongo_grades = list(mongo_db.gradenews.find())
-        supabase_grades = []
 
-        # Récupérer toutes les notes de Supabase
+        # Récupérer toutes les notes de Supabase, indexées par mongo_id
         cur.execute("""
-            SELECT g.*, cs.mongo_id as session_mongo_id
+            SELECT g.id, g.mongo_id, cs.mongo_id as session_mongo_id
             FROM education.tmp_grades g
             JOIN education.courses_sessions cs ON g.course_session_id = cs.id
         """)
-        supabase_grades = cur.fetchall()
+        supabase_grades = {mongo_id: (grade_id, session_mongo_id) for grade_id, mongo_id, session_mongo_id in cur.fetchall()}
+
+        # Nombre de notes étudiants par note, en une seule requête
+        cur.execute("""
+            SELECT grade_id, COUNT(*) FROM education.tmp_grades_records
+            GROUP BY grade_id
+        """)
+        records_counts = dict(cur.fetchall())
 
         # Vérifier le nombre de notes
-        if len(mongo_grades) != len(supabase_grades):
-            logger.error(f"Nombre de notes différent: MongoDB={len(mongo_grades)}, Supabase={len(supabase_grades)}")
+        mongo_count = mongo_db.gradenews.count_documents({})
+        if mongo_count != len(supabase_grades):
+            logger.error(f"Nombre de notes différent: MongoDB={mongo_count}, Supabase={len(supabase_grades)}")
             return False
 
         # Vérifier chaque note
-        for mongo_grade in mongo_grades:
-            supabase_grade = next((g for g in supabase_grades if g[1] == str(mongo_grade['_id'])), None)
+        for mongo_grade in stream_collection(mongo_db, 'gradenews', {'sessionId': 1, 'records': 1}):
+            supabase_grade = supabase_grades.get(str(mongo_grade['_id']))
             if not supabase_grade:
                 logger.error(f"Note {mongo_grade['_id']} non trouvée dans Supabase")
                 continue
+            grade_id, session_mongo_id = supabase_grade
 
             # Vérifier les champs de base
-            if str(mongo_grade['sessionId']) != supabase_grade[-1]:  # session_mongo_id
+            if str(mongo_grade['sessionId']) != session_mongo_id:
                 logger.error(f"ID session incorrect pour la note {mongo_grade['_id']}")
                 continue
 
             # Vérifier les notes des étudiants
-            cur.execute("""
-                SELECT COUNT(*) FROM education.tmp_grades_records
-                WHERE grade_id = %s
-            """, (supabase_grade[0],))
-            supabase_records_count = cur.fetchone()[0]
-
-            if len(mongo_grade.get('records', [])) != supabase_records_count:
+            if len(mongo_grade.get('records', [])) != records_counts.get(grade_id, 0):
                 logger.error(f"Nombre de notes étudiants incorrect pour la note {mongo_grade['_id']}")
                 continue
 
@@ -373,8 +516,247 @@ def verify_migration(pg_conn, mongo_db):
     finally:
         cur.close()
 
+def table_exists(cur, table):
+    """Indique si une table existe dans le schéma education"""
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"education.{table}",))
+    return cur.fetchone()[0]
+
+def rename_table_objects(cur, table, rename):
+    """Renomme les contraintes et index d'une table selon la fonction rename"""
+    cur.execute("""
+        SELECT conname FROM pg_constraint
+        WHERE conrelid = %s::regclass
+    """, (f"education.{table}",))
+    for (name,) in cur.fetchall():
+        cur.execute(f"ALTER TABLE education.{table} RENAME CONSTRAINT {name} TO {rename(name)}")
+
+    # Index indépendants des contraintes (les autres ont été renommés avec elles)
+    cur.execute("""
+        SELECT i.relname
+        FROM pg_index x
+        JOIN pg_class i ON i.oid = x.indexrelid
+        WHERE x.indrelid = %s::regclass
+        AND NOT EXISTS (
+            SELECT 1 FROM pg_constraint c
+            WHERE c.conindid = x.indexrelid AND c.conrelid = x.indrelid
+        )
+    """, (f"education.{table}",))
+    for (name,) in cur.fetchall():
+        cur.execute(f"ALTER INDEX education.{name} RENAME TO {rename(name)}")
+
+def column_type(data_type, udt_schema, udt_name):
+    """Type SQL d'une colonne décrite par information_schema.columns"""
+    if data_type in ('USER-DEFINED', 'ARRAY'):
+        return f"{udt_schema}.{udt_name}"
+    return data_type
+
+def load_table_columns(cur, table):
+    """Définition des colonnes d'une table du schéma education, par nom de colonne"""
+    cur.execute("""
+        SELECT column_name, data_type, udt_schema, udt_name, is_nullable = 'YES', column_default
+        FROM information_schema.columns
+        WHERE table_schema = 'education' AND table_name = %s
+    """, (table,))
+    return {
+        name: (column_type(data_type, udt_schema, udt_name), nullable, default)
+        for name, data_type, udt_schema, udt_name, nullable, default in cur.fetchall()
+    }
+
+def align_table_columns(cur, tmp_table, live_table):
+    """Aligne colonnes, valeurs par défaut et nullabilité d'une table temporaire sur la table de production"""
+    tmp_columns = load_table_columns(cur, tmp_table)
+    live_columns = load_table_columns(cur, live_table)
+
+    changes = []
+    for name, (sql_type, nullable, default) in live_columns.items():
+        if name not in tmp_columns:
+            changes.append(
+                f"ADD COLUMN {name} {sql_type}"
+                + (f" DEFAULT {default}" if default is not None else "")
+                + ("" if nullable else " NOT NULL")
+            )
+            continue
+
+        _, tmp_nullable, tmp_default = tmp_columns[name]
+        if default != tmp_default:
+            changes.append(
+                f"ALTER COLUMN {name} SET DEFAULT {default}" if default is not None
+                else f"ALTER COLUMN {name} DROP DEFAULT"
+            )
+        if nullable != tmp_nullable:
+            changes.append(f"ALTER COLUMN {name} {'DROP' if nullable else 'SET'} NOT NULL")
+
+    # Colonnes propres à la migration : l'application ne les renseigne pas
+    for name, (_, nullable, _) in tmp_columns.items():
+        if name not in live_columns and not nullable:
+            changes.append(f"ALTER COLUMN {name} DROP NOT NULL")
+
+    if changes:
+        cur.execute(f"ALTER TABLE education.{tmp_table} {', '.join(changes)}")
+        logger.info(f"{tmp_table}: {len(changes)} modifications de colonnes pour s'aligner sur {live_table}")
+
+def copy_table_privileges(cur, tmp_table, live_table):
+    """Accorde à la table temporaire les droits de la table de production (anon, authenticated...)"""
+    cur.execute("""
+        SELECT
+            CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(r.rolname) END,
+            a.privilege_type,
+            a.is_grantable
+        FROM pg_class c
+        CROSS JOIN LATERAL aclexplode(c.relacl) a
+        LEFT JOIN pg_roles r ON r.oid = a.grantee
+        WHERE c.oid = %s::regclass
+    """, (f"education.{live_table}",))
+    grants = cur.fetchall()
+    for grantee, privilege, grantable in grants:
+        cur.execute(
+            f"GRANT {privilege} ON education.{tmp_table} TO {grantee}"
+            + (" WITH GRANT OPTION" if grantable else "")
+        )
+    logger.info(f"{tmp_table}: {len(grants)} droits repris de {live_table}")
+
+def prepare_promotion(pg_conn):
+    """Aligne les tables temporaires sur le schéma de production et reconstruit leurs index avant la bascule"""
+    try:
+        cur = pg_conn.cursor()
+        start = time.perf_counter()
+
+        # student_id est obligatoire en production
+        cur.execute("SELECT COUNT(*) FROM education.tmp_grades_records WHERE student_id IS NULL")
+        unresolved = cur.fetchone()[0]
+        if unresolved:
+            raise ValueError(
+                f"{unresolved} notes étudiants sans student_id : relancer avec --computed-ids avant la bascule"
+            )
+
+        # Colonnes, valeurs par défaut, nullabilité et droits repris des tables de production
+        for tmp_table, live_table in PROMOTED_TABLES:
+            if not table_exists(cur, live_table):
+                logger.warning(f"Table education.{live_table} absente: schéma de {tmp_table} conservé")
+                continue
+            align_table_columns(cur, tmp_table, live_table)
+            copy_table_privileges(cur, tmp_table, live_table)
+        pg_conn.commit()
+
+        # Contraintes manquantes (mode différé ou reprise), puis index reconstruits et statistiques à jour
+        add_constraints(pg_conn, GRADE_CONSTRAINTS)
+        for tmp_table, _ in PROMOTED_TABLES:
+            cur.execute(f"REINDEX TABLE education.{tmp_table}")
+            cur.execute(f"ANALYZE education.{tmp_table}")
+        pg_conn.commit()
+
+        logger.info(f"Tables temporaires prêtes pour la bascule en {time.perf_counter() - start:.2f}s")
+
+    except Exception as e:
+        pg_conn.rollback()
+        logger.error(f"Erreur lors de la préparation de la bascule: {str(e)}")
+        raise
+    finally:
+        cur.close()
+
+def promote_tmp_tables(pg_conn):
+    """Remplace les tables de production des notes par les tables temporaires, en une seule transaction courte"""
+    try:
+        cur = pg_conn.cursor()
+
+        # Supprimer les sauvegardes d'une bascule précédente, hors de la transaction de bascule
+        for _, live_table in reversed(PROMOTED_TABLES):
+            cur.execute(f"DROP TABLE IF EXISTS education.{live_table}{PROMOTION_BACKUP_SUFFIX} CASCADE")
+        pg_conn.commit()
+
+        # Signaler les clés étrangères externes qui resteront attachées aux anciennes tables
+        live_tables = [f"education.{live}" for _, live in PROMOTED_TABLES if table_exists(cur, live)]
+        if live_tables:
+            cur.execute("""
+                SELECT conrelid::regclass::text, conname
+                FROM pg_constraint
+                WHERE contype = 'f'
+                AND confrelid = ANY(%s::regclass[])
+                AND conrelid <> ALL(%s::regclass[])
+            """, (live_tables, live_tables))
+            for table, constraint in cur.fetchall():
+                logger.warning(f"La contrainte {constraint} de {table} pointera vers l'ancienne table après la bascule")
+        pg_conn.commit()
+
+        start = time.perf_counter()
+        cur.execute(f"SET LOCAL lock_timeout = '{PROMOTION_LOCK_TIMEOUT}'")
+
+        # Écarter les tables de production en sauvegarde, avec leurs contraintes et index
+        for _, live_table in PROMOTED_TABLES:
+            if table_exists(cur, live_table):
+                rename_table_objects(cur, live_table, lambda name: f"{name}{PROMOTION_BACKUP_SUFFIX}")
+                cur.execute(
+                    f"ALTER TABLE education.{live_table} RENAME TO {live_table}{PROMOTION_BACKUP_SUFFIX}"
+                )
+
+        # Mettre les tables temporaires à leur place, en retirant le préfixe tmp_ de leurs objets
+        for tmp_table, live_table in PROMOTED_TABLES:
+            rename_table_objects(
+                cur, tmp_table,
+                lambda name: live_table + name[len(tmp_table):] if name.startswith(tmp_table) else name
+            )
+            cur.execute(f"ALTER TABLE education.{tmp_table} RENAME TO {live_table}")
+
+        pg_conn.commit()
+        logger.info(f"Tables des notes basculées en production en {time.perf_counter() - start:.2f}s")
+
+    except Exception as e:
+        pg_conn.rollback()
+        logger.error(f"Erreur lors de la bascule des tables des notes: {str(e)}")
+        raise
+    finally:
+        cur.close()
+
+def parse_args():
+    """Analyse les arguments de la ligne de commande"""
+    parser = argparse.ArgumentParser(description="Migration des notes de MongoDB vers Supabase")
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help="Migre les notes par lots avec des UUID générés côté Python"
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=GRADE_BATCH_SIZE,
+        help=f"Nombre de notes par transaction en mode batch (défaut: {GRADE_BATCH_SIZE})"
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help="Reprend une migration interrompue sans supprimer les tables, en ignorant les documents déjà migrés"
+    )
+    parser.add_argument(
+        '--defer-constraints',
+        action='store_true',
+        help="Crée des tables nues et ajoute clés et index après le chargement (à combiner avec --batch)"
+    )
+    parser.add_argument(
+        '--session-cache-size',
+        type=int,
+        default=SESSION_CACHE_SIZE,
+        help="Taille du cache LRU des sessions ; 0 précharge toutes les sessions au démarrage (défaut: 0)"
+    )
+    parser.add_argument(
+        '--stats',
+        choices=('check', 'repair'),
+        help="Recalcule les statistiques des notes depuis les notes étudiants et signale (check) ou corrige (repair) les écarts"
+    )
+    parser.add_argument(
+        '--promote',
+        action='store_true',
+        help="Après une vérification réussie, bascule les tables temporaires en tables de production"
+    )
+    parser.add_argument(
+        '--computed-ids',
+        action='store_true',
+        help="Calcule student_id et teacher_id depuis les ObjectId à l'insertion"
+    )
+    return parser.parse_args()
+
 def main():
     """Fonction principale"""
+    args = parse_args()
     try:
         # Connexion à MongoDB
         mongo_db = connect_mongodb()
@@ -384,31 +766,82 @@ def main():
         pg_conn = connect_supabase()
         logger.info("Connexion à Supabase réussie")
 
-        # Supprimer les tables temporaires existantes
-        drop_tmp_tables(pg_conn)
-        logger.info("Tables temporaires supprimées")
+        # Supprimer les tables temporaires existantes (conservées en mode reprise)
+        if not args.resume:
+            drop_tmp_tables(pg_conn)
+            logger.info("Tables temporaires supprimées")
 
         # Créer les nouvelles tables temporaires
-        create_tmp_tables(pg_conn)
+        create_tmp_tables(pg_conn, defer_constraints=args.defer_constraints)
         logger.info("Nouvelles tables temporaires créées")
 
         # Récupérer les notes de MongoDB
         mongo_grades = get_mongo_grades(mongo_db)
-        logger.info(f"Nombre de notes à migrer: {len(mongo_grades)}")
+
+        # En mode reprise, écarter en amont les notes déjà migrées
+        if args.resume:
+            existing_ids = load_existing_mongo_ids(pg_conn, 'education.tmp_grades')
+            mongo_grades = skip_existing(mongo_grades, pg_conn, 'education.tmp_grades', existing_ids)
+
+        # UUID des utilisateurs existants, pour calculer les références à l'insertion
+        user_ids = load_user_ids(pg_conn) if args.computed_ids else None
+
+        # Sessions de cours résolues une seule fois pour toutes les notes
+        session_lookup = make_session_lookup(pg_conn, args.session_cache_size)
+
+        # Pas de vérification par document en reprise (déjà filtrés) ni sans index unique sur mongo_id
+        check_existing = not args.resume and not args.defer_constraints
 
         # Migrer chaque note
-        for grade in mongo_grades:
-            try:
-                migrate_grade(pg_conn, grade)
-            except Exception as e:
-                logger.error(f"Erreur lors de la migration de la note {grade['_id']}: {str(e)}")
-                continue
+        if args.batch:
+            for i, batch in enumerate(iter_chunks(mongo_grades, args.batch_size), 1):
+                try:
+                    migrate_grades_batch(pg_conn, batch, user_ids, session_lookup, check_existing)
+                except Exception:
+                    # Rejouer le lot note par note pour isoler la note en erreur
+                    logger.warning(f"Lot {i} en erreur, migration note par note...")
+                    for grade in batch:
+                        try:
+                            migrate_grade(pg_conn, grade, check_existing=check_existing, user_ids=user_ids, session_lookup=session_lookup)
+                        except Exception as e:
+                            logger.error(f"Erreur lors de la migration de la note {grade['_id']}: {str(e)}")
+                            continue
+        else:
+            for grade in mongo_grades:
+                try:
+                    migrate_grade(pg_conn, grade, check_existing=check_existing, user_ids=user_ids, session_lookup=session_lookup)
+                except Exception as e:
+                    logger.error(f"Erreur lors de la migration de la note {grade['_id']}: {str(e)}")
+                    continue
+
+        # Ajouter les contraintes différées une fois les données chargées
+        if args.defer_constraints:
+            add_constraints(pg_conn, GRADE_CONSTRAINTS)
+            logger.info("Contraintes différées ajoutées")
+
+        # Une seule jointure par table pour signaler les utilisateurs introuvables
+        if args.computed_ids:
+            verify_user_references(pg_conn, 'tmp_grades_records', 'mongo_student_id', 'student_id')
+            verify_user_references(pg_conn, 'tmp_grades_teachers_migration', 'mongo_teacher_id', 'teacher_id')
+
+        # Recalculer les statistiques dénormalisées copiées depuis MongoDB
+        if args.stats:
+            # Import local : NumPy n'est requis que pour ce contrôle
+            from grades_stats import check_grade_stats
+            check_grade_stats(pg_conn, repair=args.stats == 'repair')
 
         # Vérifier la migration
         if verify_migration(pg_conn, mongo_db):
             logger.info("Migration terminée avec succès")
+
+            # Basculer les tables en production une fois les données vérifiées
+            if args.promote:
+                prepare_promotion(pg_conn)
+                promote_tmp_tables(pg_conn)
         else:
             logger.error("Des erreurs ont été trouvées lors de la vérification")
+            if args.promote:
+                logger.error("Bascule en production annulée")
 
     except Exception as e:
         logger.error(f"Erreur lors de la migration: {str(e)}")
@@ -0,0 +1,173 @@
+import logging
+import time
+import numpy as np
+from pg_copy import copy_rows
+
+logger = logging.getLogger(__name__)
+
+# Statistiques dénormalisées des notes, dans l'ordre des colonnes des tableaux
+STATS_COLUMNS = (
+    'stats_average_grade',
+    'stats_highest_grade',
+    'stats_lowest_grade',
+    'stats_absent_count',
+    'stats_total_students'
+)
+
+# Écart toléré entre statistiques stockées et recalculées (moyennes arrondies dans MongoDB)
+STATS_TOLERANCE = 0.01
+
+def load_stored_stats(pg_conn, grades_table='tmp_grades'):
+    """Charge les statistiques stockées de toutes les notes dans un tableau (n, 5)"""
+    cur = pg_conn.cursor()
+    try:
+        cur.execute(f"SELECT id::text, {', '.join(STATS_COLUMNS)} FROM education.{grades_table}")
+        rows = cur.fetchall()
+
+        grade_ids = [row[0] for row in rows]
+        # Les NULL deviennent NaN grâce au dtype float
+        stored = np.array([row[1:] for row in rows], dtype=float).reshape(len(rows), len(STATS_COLUMNS))
+        return grade_ids, stored
+    finally:
+        cur.close()
+
+def load_grade_records(pg_conn, grade_index, records_table='tmp_grades_records'):
+    """Charge les notes étudiants en tableaux NumPy, avec la position de leur note dans grade_index"""
+    cur = pg_conn.cursor()
+    try:
+        cur.execute(f"SELECT grade_id::text, value, is_absent FROM education.{records_table}")
+        rows = cur.fetchall()
+
+        positions = np.fromiter((grade_index.get(row[0], -1) for row in rows), dtype=np.int64, count=len(rows))
+        values = np.array([row[1] for row in rows], dtype=float)
+        absent = np.fromiter((bool(row[2]) for row in rows), dtype=bool, count=len(rows))
+        return positions, values, absent
+    finally:
+        cur.close()
+
+def compute_grade_stats(positions, values, absent, grade_count):
+    """Recalcule les cinq statistiques de chaque note par réductions groupées vectorisées"""
+    known = positions >= 0
+    positions, values, absent = positions[known], values[known], absent[known]
+
+    total_students = np.bincount(positions, minlength=grade_count)
+    absent_count = np.bincount(positions[absent], minlength=grade_count)
+
+    # Moyenne, maximum et minimum sur les étudiants présents ayant une note
+    valid = ~absent & ~np.isnan(values)
+    valid_positions, valid_values = positions[valid], values[valid]
+    valid_count = np.bincount(valid_positions, minlength=grade_count)
+    sums = np.bincount(valid_positions, weights=valid_values, minlength=grade_count)
+
+    # Sans note valide (tous absents), l'application stocke 0 (calculateGradeStats)
+    average = np.zeros(grade_count)
+    np.divide(sums, valid_count, out=average, where=valid_count > 0)
+
+    highest = np.zeros(grade_count)
+    lowest = np.zeros(grade_count)
+    if valid_positions.size:
+        order = np.argsort(valid_positions, kind='stable')
+        sorted_positions = valid_positions[order]
+        sorted_values = valid_values[order]
+        starts = np.flatnonzero(np.r_[True, sorted_positions[1:] != sorted_positions[:-1]])
+        groups = sorted_positions[starts]
+        highest[groups] = np.maximum.reduceat(sorted_values, starts)
+        lowest[groups] = np.minimum.reduceat(sorted_values, starts)
+
+    return np.column_stack([average, highest, lowest, absent_count, total_students]).astype(float)
+
+def find_stats_mismatches(stored, computed, tolerance=STATS_TOLERANCE):
+    """Renvoie le masque (n, 5) des statistiques stockées qui diffèrent du recalcul"""
+    both_missing = np.isnan(stored) & np.isnan(computed)
+    close = np.isclose(stored, computed, rtol=0, atol=tolerance)
+    return ~(close | both_missing)
+
+def _to_db_value(value, integer=False):
+    """Convertit une valeur NumPy en valeur Python pour COPY (NaN -> NULL)"""
+    if np.isnan(value):
+        return None
+    return int(value) if integer else float(value)
+
+def repair_grade_stats(pg_conn, grade_ids, computed, rows_to_fix, grades_table='tmp_grades'):
+    """Réécrit en une seule requête les statistiques des notes incohérentes"""
+    cur = pg_conn.cursor()
+    try:
+        rows = [
+            (
+                grade_ids[i],
+                _to_db_value(computed[i, 0]),
+                _to_db_value(computed[i, 1]),
+                _to_db_value(computed[i, 2]),
+                _to_db_value(computed[i, 3], integer=True),
+                _to_db_value(computed[i, 4], integer=True)
+            )
+            for i in rows_to_fix
+        ]
+
+        cur.execute("""
+            CREATE TEMP TABLE grade_stats_stage (
+                id UUID PRIMARY KEY,
+                stats_average_grade DECIMAL,
+                stats_highest_grade DECIMAL,
+                stats_lowest_grade DECIMAL,
+                stats_absent_count INTEGER,
+                stats_total_students INTEGER
+            ) ON COMMIT DROP
+        """)
+        copy_rows(cur, 'grade_stats_stage', ('id',) + STATS_COLUMNS, rows)
+
+        cur.execute(f"""
+            UPDATE education.{grades_table} g
+            SET {', '.join(f'{column} = s.{column}' for column in STATS_COLUMNS)},
+                updated_at = NOW()
+            FROM grade_stats_stage s
+            WHERE g.id = s.id
+        """)
+        updated = cur.rowcount
+
+        pg_conn.commit()
+        logger.info(f"Statistiques corrigées pour {updated} notes")
+        return updated
+
+    except Exception as e:
+        pg_conn.rollback()
+        logger.error(f"Erreur lors de la correction des statistiques: {str(e)}")
+        raise
+    finally:
+        cur.close()
+
+def check_grade_stats(pg_conn, repair=False, grades_table='tmp_grades', records_table='tmp_grades_records'):
+    """Recalcule les statistiques de toutes les notes, signale les écarts et les corrige si demandé"""
+    try:
+        start = time.perf_counter()
+        grade_ids, stored = load_stored_stats(pg_conn, grades_table)
+        grade_index = {grade_id: i for i, grade_id in enumerate(grade_ids)}
+        positions, values, absent = load_grade_records(pg_conn, grade_index, records_table)
+        pg_conn.commit()
+        loaded = time.perf_counter()
+
+        computed = compute_grade_stats(positions, values, absent, len(grade_ids))
+        mismatches = find_stats_mismatches(stored, computed)
+        rows_to_fix = np.flatnonzero(mismatches.any(axis=1))
+        computed_at = time.perf_counter()
+
+        logger.info(
+            f"Statistiques recalculées pour {len(grade_ids)} notes et {len(positions)} notes étudiants "
+            f"(chargement {loaded - start:.2f}s, calcul {computed_at - loaded:.3f}s)"
+        )
+        for column, count in zip(STATS_COLUMNS, mismatches.sum(axis=0)):
+            if count:
+                logger.warning(f"- {column}: {count} notes incohérentes")
+
+        if not rows_to_fix.size:
+            logger.info("Toutes les statistiques des notes sont cohérentes")
+            return 0
+
+        logger.warning(f"{rows_to_fix.size} notes ont des statistiques incohérentes")
+        if repair:
+            repair_grade_stats(pg_conn, grade_ids, computed, rows_to_fix, grades_table)
+        return int(rows_to_fix.size)
+
+    except Exception as e:
+        logger.error(f"Erreur lors du recalcul des statistiques des notes: {str(e)}")
+        raise
@@ -0,0 +1,163 @@
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Mapping binaire partagé par les scripts de migration
+ID_MAP_FILE = 'mongo_to_supabase_ids.bin'
+
+# Mapping JSON historique écrit par users_migrate_all.py
+JSON_MAP_FILE = 'mongo_to_supabase_ids.json'
+
+# En-tête : signature du format puis nombre d'enregistrements
+MAGIC = b'OIDMAP01'
+HEADER = struct.Struct('<8sQ')
+
+# Enregistrements de taille fixe triés : ObjectId (12 octets) puis UUID (16 octets)
+OBJECTID_SIZE = 12
+UUID_SIZE = 16
+RECORD_SIZE = OBJECTID_SIZE + UUID_SIZE
+
+def write_id_map(mapping, path=ID_MAP_FILE):
+    """Écrit atomiquement un mapping mongo_id -> UUID au format binaire trié"""
+    records = []
+    skipped = 0
+    for mongo_id, supabase_id in mapping.items():
+        # Une clé qui n'est pas un ObjectId de 12 octets décalerait tous les enregistrements suivants
+        try:
+            objectid = bytes.fromhex(str(mongo_id))
+        except ValueError:
+            objectid = b''
+        if len(objectid) != OBJECTID_SIZE:
+            logger.warning(f"Clé de mapping ignorée, ObjectId invalide: {mongo_id!r}")
+            skipped += 1
+            continue
+        records.append((objectid, uuid.UUID(str(supabase_id)).bytes))
+    records.sort()
+    if skipped:
+        logger.warning(f"{skipped} clés invalides ignorées lors de l'écriture de {path}")
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(records)))
+        for objectid, supabase_uuid in records:
+            f.write(objectid)
+            f.write(supabase_uuid)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(records)
+
+def load_json_mapping(json_path=JSON_MAP_FILE):
+    """Lit le mapping JSON historique et le réindexe par mongo_id"""
+    with open(json_path, 'r') as f:
+        data = json.load(f)
+
+    return {
+        user_data['mongo_id']: user_data['supabase_id']
+        for user_data in data.values()
+        if user_data.get('mongo_id') and user_data.get('supabase_id')
+    }
+
+class _SortedKeys:
+    """Vue en séquence des ObjectId du fichier, pour la recherche dichotomique"""
+
+    def __init__(self, buffer, count):
+        self.buffer = buffer
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        offset = HEADER.size + index * RECORD_SIZE
+        return self.buffer[offset:offset + OBJECTID_SIZE]
+
+class IdMapStore:
+    """Mapping mongo_id -> UUID en lecture seule, projeté en mémoire et interrogé par dichotomie"""
+
+    def __init__(self, path=ID_MAP_FILE):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self._count = HEADER.unpack_from(self._buffer, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"Format de mapping inconnu: {path}")
+        if HEADER.size + self._count * RECORD_SIZE > len(self._buffer):
+            self.close()
+            raise ValueError(f"Fichier de mapping tronqué: {path}")
+
+        self._keys = _SortedKeys(self._buffer, self._count)
+
+    def _uuid_at(self, index):
+        offset = HEADER.size + index * RECORD_SIZE + OBJECTID_SIZE
+        return str(uuid.UUID(bytes=self._buffer[offset:offset + UUID_SIZE]))
+
+    def _find(self, mongo_id):
+        try:
+            key = bytes.fromhex(str(mongo_id))
+        except ValueError:
+            return None
+        if len(key) != OBJECTID_SIZE:
+            return None
+
+        index = bisect.bisect_left(self._keys, key)
+        if index < self._count and self._keys[index] == key:
+            return index
+        return None
+
+    def get(self, mongo_id, default=None):
+        index = self._find(mongo_id)
+        return default if index is None else self._uuid_at(index)
+
+    def __getitem__(self, mongo_id):
+        index = self._find(mongo_id)
+        if index is None:
+            raise KeyError(mongo_id)
+        return self._uuid_at(index)
+
+    def __contains__(self, mongo_id):
+        return self._find(mongo_id) is not None
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        for index in range(self._count):
+            yield self._keys[index].hex()
+
+    def items(self):
+        for index in range(self._count):
+            yield self._keys[index].hex(), self._uuid_at(index)
+
+    def close(self):
+        self._buffer.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_id_map(path=ID_MAP_FILE, json_path=JSON_MAP_FILE):
+    """Ouvre le mapping binaire, en le régénérant depuis le JSON s'il est absent ou plus ancien"""
+    if os.path.exists(json_path) and (
+        not os.path.exists(path) or os.path.getmtime(json_path) > os.path.getmtime(path)
+    ):
+        write_id_map(load_json_mapping(json_path), path)
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"Le fichier {path} n'existe pas")
+
+    return IdMapStore(path)
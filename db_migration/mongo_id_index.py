@@ -0,0 +1,108 @@
+import hashlib
+import logging
+import math
+from mongo_stream import iter_chunks
+
+logger = logging.getLogger(__name__)
+
+# Au-delà de ce nombre de lignes, l'index exact est remplacé par un filtre de Bloom
+BLOOM_THRESHOLD = 1_000_000
+
+# Taux de faux positifs visé par le filtre de Bloom
+BLOOM_ERROR_RATE = 0.001
+
+# Nombre de lignes lues par aller-retour lors du chargement de l'index
+FETCH_SIZE = 10000
+
+# Nombre de documents dont les positifs du filtre de Bloom sont confirmés en une requête
+CONFIRM_CHUNK_SIZE = 1000
+
+def _compact_key(mongo_id):
+    """Réduit un ObjectId hexadécimal à ses 12 octets, ou garde la chaîne telle quelle"""
+    mongo_id = str(mongo_id)
+    if len(mongo_id) == 24:
+        try:
+            return bytes.fromhex(mongo_id)
+        except ValueError:
+            pass
+    return mongo_id
+
+class BloomFilter:
+    """Filtre de Bloom minimal sur un bytearray, pour les très grosses tables"""
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        if isinstance(key, str):
+            key = key.encode()
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+def load_existing_mongo_ids(pg_conn, table, bloom_threshold=BLOOM_THRESHOLD):
+    """Charge une seule fois les mongo_id déjà présents dans une table Supabase"""
+    cur = pg_conn.cursor()
+    cur.execute(f"SELECT COUNT(*) FROM {table}")
+    count = cur.fetchone()[0]
+    cur.close()
+
+    if count > bloom_threshold:
+        index = BloomFilter(count)
+        logger.info(f"Index des mongo_id de {table}: filtre de Bloom pour {count} lignes")
+    else:
+        index = set()
+        logger.info(f"Index des mongo_id de {table}: ensemble exact pour {count} lignes")
+
+    # Curseur côté serveur pour ne pas matérialiser toute la table
+    cur = pg_conn.cursor(name=f"existing_mongo_ids_{table.replace('.', '_')}")
+    cur.itersize = FETCH_SIZE
+    cur.execute(f"SELECT mongo_id FROM {table}")
+    for (mongo_id,) in cur:
+        index.add(_compact_key(mongo_id))
+    cur.close()
+    pg_conn.commit()
+
+    return index
+
+def existing_mongo_ids(pg_conn, table, mongo_ids):
+    """Renvoie en une requête les mongo_id déjà présents en base (confirmation des positifs du filtre de Bloom)"""
+    if not mongo_ids:
+        return set()
+    cur = pg_conn.cursor()
+    try:
+        cur.execute(f"SELECT mongo_id FROM {table} WHERE mongo_id = ANY(%s)", (list(mongo_ids),))
+        return {row[0] for row in cur.fetchall()}
+    finally:
+        cur.close()
+
+def skip_existing(documents, pg_conn, table, index, chunk_size=CONFIRM_CHUNK_SIZE):
+    """Filtre un flux de documents MongoDB en écartant ceux déjà migrés"""
+    skipped = 0
+    for chunk in iter_chunks(documents, chunk_size):
+        hits = [str(document['_id']) for document in chunk if _compact_key(document['_id']) in index]
+
+        # Un positif du filtre de Bloom peut être un faux positif : on confirme ceux du lot en une requête
+        if isinstance(index, BloomFilter):
+            hits = existing_mongo_ids(pg_conn, table, hits)
+        else:
+            hits = set(hits)
+
+        for document in chunk:
+            if str(document['_id']) in hits:
+                skipped += 1
+                continue
+            yield document
+
+    logger.info(f"Reprise: {skipped} documents déjà présents dans {table} ignorés")
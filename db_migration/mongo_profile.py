@@ -0,0 +1,185 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import os
+import json
+import time
+import argparse
+import logging
+from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient
+
+logger = logging.getLogger(__name__)
+
+# Nombre de documents échantillonnés par collection
+PROFILE_SAMPLE_SIZE = 100
+
+# Nombre de collections profilées en parallèle
+PROFILE_WORKERS = 4
+
+# Fichier JSON du schéma fusionné
+PROFILE_OUTPUT_FILE = 'mongo_profile.json'
+
+def connect_mongodb():
+    """Connexion à MongoDB"""
+    try:
+        mongo_uri = os.getenv('MONGODB_URI')
+        if not mongo_uri:
+            raise ValueError("MONGODB_URI non définie")
+
+        client = MongoClient(mongo_uri)
+        db = client.get_database('cours-a-la-mosquee')
+        logger.info("Connexion à MongoDB réussie")
+        return db
+    except Exception as e:
+        logger.error(f"Erreur de connexion à MongoDB: {str(e)}")
+        raise
+
+def type_name(value):
+    """Nom du type BSON d'une valeur, tel qu'affiché dans le schéma"""
+    if value is None:
+        return 'null'
+    if isinstance(value, dict):
+        return 'object'
+    if isinstance(value, list):
+        return 'array'
+    return type(value).__name__
+
+def collect_fields(value, path, types, seen):
+    """Parcourt récursivement un document et relève le type de chaque champ (notation pointée, [] pour les tableaux)"""
+    if path:
+        types[path][type_name(value)] += 1
+        seen.add(path)
+
+    if isinstance(value, dict):
+        for key, child in value.items():
+            collect_fields(child, f"{path}.{key}" if path else key, types, seen)
+    elif isinstance(value, list):
+        for item in value:
+            collect_fields(item, f"{path}[]", types, seen)
+
+def merge_schema(documents):
+    """Fusionne le schéma d'un échantillon de documents, avec la fréquence de chaque champ"""
+    types = defaultdict(lambda: defaultdict(int))
+    presence = defaultdict(int)
+
+    for document in documents:
+        seen = set()
+        collect_fields(document, '', types, seen)
+        for path in seen:
+            presence[path] += 1
+
+    sampled = len(documents)
+    return {
+        path: {
+            'count': presence[path],
+            'frequency': round(presence[path] / sampled, 4) if sampled else 0,
+            'types': dict(types[path])
+        }
+        for path in sorted(types)
+    }
+
+def profile_collection(mongo_db, collection_name, sample_size=PROFILE_SAMPLE_SIZE):
+    """Profile une collection : nombre estimé de documents et schéma d'un échantillon $sample"""
+    start = time.perf_counter()
+    collection = mongo_db[collection_name]
+
+    # Estimation depuis les métadonnées, sans parcourir la collection
+    estimated_count = collection.estimated_document_count()
+    documents = list(collection.aggregate([{'$sample': {'size': sample_size}}])) if estimated_count else []
+
+    profile = {
+        'estimated_count': estimated_count,
+        'sampled': len(documents),
+        'fields': merge_schema(documents)
+    }
+    logger.info(
+        f"- {collection_name}: ~{estimated_count} documents, {len(documents)} échantillonnés, "
+        f"{len(profile['fields'])} champs ({time.perf_counter() - start:.2f}s)"
+    )
+    return profile
+
+def profile_database(mongo_db, collections=None, sample_size=PROFILE_SAMPLE_SIZE, workers=PROFILE_WORKERS):
+    """Profile plusieurs collections en parallèle et renvoie le schéma fusionné de chacune"""
+    try:
+        collections = collections or sorted(mongo_db.list_collection_names())
+        logger.info(f"Profilage de {len(collections)} collections ({sample_size} documents par collection)...")
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {
+                name: executor.submit(profile_collection, mongo_db, name, sample_size)
+                for name in collections
+            }
+
+        profiles = {}
+        for name, future in futures.items():
+            try:
+                profiles[name] = future.result()
+            except Exception as e:
+                logger.error(f"Erreur lors du profilage de la collection {name}: {str(e)}")
+
+        return {
+            'generated_at': datetime.now().isoformat(),
+            'sample_size': sample_size,
+            'collections': profiles
+        }
+
+    except Exception as e:
+        logger.error(f"Erreur lors du profilage: {str(e)}")
+        raise
+
+def save_profile(profile, output_file=PROFILE_OUTPUT_FILE):
+    """Écrit le profil en JSON"""
+    with open(output_file, 'w') as f:
+        json.dump(profile, f, indent=2, ensure_ascii=False)
+    logger.info(f"Profil écrit dans {output_file}")
+
+def parse_args():
+    """Analyse les arguments de la ligne de commande"""
+    parser = argparse.ArgumentParser(description="Profilage rapide des collections MongoDB")
+    parser.add_argument(
+        'collections',
+        nargs='*',
+        help="Collections à profiler (défaut: toutes)"
+    )
+    parser.add_argument(
+        '--sample-size',
+        type=int,
+        default=PROFILE_SAMPLE_SIZE,
+        help=f"Nombre de documents échantillonnés par collection (défaut: {PROFILE_SAMPLE_SIZE})"
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=PROFILE_WORKERS,
+        help=f"Nombre de collections profilées en parallèle (défaut: {PROFILE_WORKERS})"
+    )
+    parser.add_argument(
+        '--output',
+        default=PROFILE_OUTPUT_FILE,
+        help=f"Fichier JSON de sortie (défaut: {PROFILE_OUTPUT_FILE})"
+    )
+    return parser.parse_args()
+
+def main():
+    """Fonction principale"""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    args = parse_args()
+    try:
+        mongo_db = connect_mongodb()
+        profile = profile_database(mongo_db, args.collections, args.sample_size, args.workers)
+        save_profile(profile, args.output)
+
+    except Exception as e:
+        logger.error(f"Erreur: {str(e)}")
+    finally:
+        if 'mongo_db' in locals():
+            mongo_db.client.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+from itertools import islice
+
+# Nombre de documents rapatriés par aller-retour avec le serveur MongoDB
+MONGO_BATCH_SIZE = 1000
+
+def stream_collection(db, collection_name, projection=None, query=None, batch_size=MONGO_BATCH_SIZE):
+    """Itère sur une collection MongoDB par lots bornés, sans la charger en mémoire"""
+    cursor = db[collection_name].find(query or {}, projection, batch_size=batch_size)
+    try:
+        for document in cursor:
+            yield document
+    finally:
+        cursor.close()
+
+def iter_chunks(iterable, size):
+    """Regroupe un itérable en listes d'au plus size éléments"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,37 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+def add_constraints(pg_conn, constraints):
+    """Ajoute clés primaires, index uniques puis clés étrangères, en chronométrant chaque étape.
+
+    constraints est une liste de (nom, table, définition) dans l'ordre où elles peuvent être ajoutées.
+    """
+    cur = pg_conn.cursor()
+    try:
+        total_start = time.perf_counter()
+
+        # Ignorer les contraintes déjà présentes (tables conservées en mode reprise)
+        cur.execute("""
+            SELECT conname FROM pg_constraint
+            WHERE connamespace = 'education'::regnamespace
+        """)
+        existing = {row[0] for row in cur.fetchall()}
+
+        for name, table, definition in constraints:
+            if name in existing:
+                continue
+            start = time.perf_counter()
+            cur.execute(f"ALTER TABLE education.{table} ADD CONSTRAINT {name} {definition}")
+            logger.info(f"Contrainte {name} ajoutée en {time.perf_counter() - start:.2f}s")
+
+        pg_conn.commit()
+        logger.info(f"Contraintes ajoutées en {time.perf_counter() - total_start:.2f}s")
+
+    except Exception as e:
+        pg_conn.rollback()
+        logger.error(f"Erreur lors de l'ajout des contraintes: {str(e)}")
+        raise
+    finally:
+        cur.close()
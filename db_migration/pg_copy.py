@@ -0,0 +1,83 @@
+import io
+import logging
+from datetime import date, datetime, time
+
+logger = logging.getLogger(__name__)
+
+# Taille par défaut des lots envoyés via COPY
+COPY_CHUNK_SIZE = 500
+
+def _escape_copy_text(text):
+    """Échappe une chaîne pour le format texte de COPY"""
+    return (
+        text.replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
+
+def _format_array_item(value):
+    """Formate un élément de tableau PostgreSQL"""
+    if value is None:
+        return 'NULL'
+    text = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{text}"'
+
+def format_copy_value(value):
+    """Convertit une valeur Python au format texte de COPY"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return _escape_copy_text('{' + ','.join(_format_array_item(v) for v in value) + '}')
+    return _escape_copy_text(str(value))
+
+def copy_rows(cur, table, columns, rows):
+    """Charge une liste de lignes dans une table via COPY FROM STDIN"""
+    if not rows:
+        return 0
+
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(format_copy_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN",
+        buffer
+    )
+    return len(rows)
+
+def copy_with_savepoint_fallback(pg_conn, cur, items, copy_fn):
+    """Charge un lot via copy_fn(cur, items) ; en cas d'échec, le rejoue élément par élément sous SAVEPOINT.
+
+    Renvoie les éléments chargés et la liste des (élément, erreur) rejetés. Le lot est validé dans les deux cas.
+    """
+    try:
+        copy_fn(cur, items)
+        pg_conn.commit()
+        return list(items), []
+    except Exception as e:
+        pg_conn.rollback()
+        logger.warning(f"Lot de {len(items)} éléments en erreur ({str(e)}), chargement élément par élément...")
+
+    # Point de sauvegarde : un élément en erreur n'annule pas le reste du lot
+    loaded = []
+    failed = []
+    for item in items:
+        cur.execute("SAVEPOINT copy_item")
+        try:
+            copy_fn(cur, [item])
+            cur.execute("RELEASE SAVEPOINT copy_item")
+            loaded.append(item)
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT copy_item")
+            failed.append((item, e))
+
+    # Valider le lot pour ne pas garder une transaction ouverte sur toute la migration
+    pg_conn.commit()
+    return loaded, failed
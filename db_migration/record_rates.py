@@ -0,0 +1,69 @@
+import math
+
+def flatten_records(documents, value):
+    """Aplatit les records d'un lot de documents en tableaux (index du parent, valeur)"""
+    # Import local : NumPy n'est requis que pour le calcul vectorisé
+    import numpy as np
+
+    totals = np.fromiter(
+        (len(document.get('records') or []) for document in documents),
+        dtype=np.int64,
+        count=len(documents)
+    )
+    values = np.fromiter(
+        (value(record) for document in documents for record in document.get('records') or []),
+        dtype=float,
+        count=int(totals.sum())
+    )
+    parents = np.repeat(np.arange(len(documents)), totals)
+    return parents, values, totals
+
+def _vectorized_rates(documents, value, scale):
+    """Taux de tout le lot en une passe NumPy (NaN pour un document ayant une valeur manquante)"""
+    import numpy as np
+
+    parents, values, totals = flatten_records(documents, value)
+    sums = np.bincount(parents, weights=values, minlength=len(documents))
+
+    rates = np.zeros(len(documents))
+    np.divide(sums * scale, totals, out=rates, where=totals > 0)
+    return rates.tolist(), totals.tolist()
+
+def document_rate(document, value, scale=1.0):
+    """Taux d'un seul document, None si l'une de ses valeurs n'est pas numérique"""
+    records = document.get('records') or []
+    if not records:
+        return 0.0
+    try:
+        rate = sum(float(value(record)) for record in records) * scale / len(records)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(rate) else rate
+
+def compute_record_rates(documents, value, scale=1.0):
+    """Calcule en une passe vectorisée la moyenne de value sur les records de chaque document.
+
+    Renvoie deux listes Python alignées sur documents : les taux (0 sans record,
+    None si une valeur n'est pas numérique) et le nombre de records. Sans NumPy,
+    ou si le lot contient une valeur invalide, le calcul se fait document par document.
+    """
+    try:
+        rates, totals = _vectorized_rates(documents, value, scale)
+    except (ImportError, TypeError, ValueError):
+        # NumPy absent, ou une valeur non convertible qui fait échouer tout le lot
+        totals = [len(document.get('records') or []) for document in documents]
+        return [document_rate(document, value, scale) for document in documents], totals
+
+    # None (converti en NaN par NumPy) : recalculer le document pour le signaler invalide
+    return [
+        document_rate(document, value, scale) if math.isnan(rate) else rate
+        for document, rate in zip(documents, rates)
+    ], totals
+
+def behavior_rates(behaviors):
+    """Taux de comportement (note moyenne) et nombre d'étudiants de chaque behavior"""
+    return compute_record_rates(behaviors, lambda record: record.get('rating', 0))
+
+def presence_rates(attendances):
+    """Taux de présence (en %) et nombre d'étudiants de chaque attendance"""
+    return compute_record_rates(attendances, lambda record: bool(record.get('isPresent', False)), scale=100.0)
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+# Les scripts de migration s'importent entre eux depuis db_migration/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from grades_stats import compute_grade_stats, find_stats_mismatches
+
+def test_all_absent_grade_matches_app_stats():
+    """Une note où tous les étudiants sont absents est stockée à 0 par l'application"""
+    positions = np.array([0, 0, 0, 1, 1], dtype=np.int64)
+    values = np.array([np.nan, np.nan, np.nan, 12.0, 16.0])
+    absent = np.array([True, True, True, False, False])
+
+    computed = compute_grade_stats(positions, values, absent, 2)
+    stored = np.array([
+        [0, 0, 0, 3, 3],
+        [14, 16, 12, 0, 2]
+    ], dtype=float)
+
+    assert not find_stats_mismatches(stored, computed).any()
@@ -0,0 +1,63 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+def objectid_to_uuid(objectid) -> str:
+    """Convertit un ObjectId MongoDB en UUID string"""
+    # Convertir l'ObjectId en hexadécimal
+    hex_str = str(objectid)
+    # S'assurer que nous avons 32 caractères hexadécimaux
+    hex_str = hex_str.ljust(32, '0')
+    # Formater en UUID standard (8-4-4-4-12 caractères)
+    return f"{hex_str[:8]}-{hex_str[8:12]}-{hex_str[12:16]}-{hex_str[16:20]}-{hex_str[20:32]}"
+
+def objectids_to_uuids(objectids):
+    """Convertit en une passe une liste d'ObjectId en UUID strings"""
+    return [
+        f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:32]}"
+        for h in (str(objectid).ljust(32, '0') for objectid in objectids)
+    ]
+
+def load_user_ids(pg_conn):
+    """Charge une seule fois les UUID des utilisateurs présents dans Supabase"""
+    cur = pg_conn.cursor()
+    try:
+        cur.execute("SELECT id::text FROM education.users")
+        user_ids = {row[0] for row in cur.fetchall()}
+        logger.info(f"UUID utilisateurs chargés: {len(user_ids)}")
+        return user_ids
+    finally:
+        cur.close()
+
+def resolve_user_ids(objectids, user_ids):
+    """Calcule les UUID des utilisateurs référencés, None pour ceux absents de Supabase"""
+    return [
+        user_uuid if user_uuid in user_ids else None
+        for user_uuid in objectids_to_uuids(objectids)
+    ]
+
+def verify_user_references(pg_conn, table, mongo_column, id_column):
+    """Vérifie en une seule jointure que les utilisateurs référencés par une table existent"""
+    cur = pg_conn.cursor()
+    try:
+        cur.execute(f"""
+            SELECT t.{mongo_column}, COUNT(*)
+            FROM education.{table} t
+            LEFT JOIN education.users u ON u.id = t.{id_column}
+            WHERE u.id IS NULL
+            GROUP BY t.{mongo_column}
+        """)
+        unresolved = dict(cur.fetchall())
+
+        if unresolved:
+            logger.warning(
+                f"education.{table}: {sum(unresolved.values())} lignes sans {id_column} "
+                f"({len(unresolved)} IDs MongoDB uniques absents de education.users):"
+            )
+            for mongo_id in sorted(unresolved):
+                logger.warning(f"  - {mongo_id}")
+        else:
+            logger.info(f"education.{table}: toutes les références {id_column} sont résolues")
+        return unresolved
+    finally:
+        cur.close()
@@ -3,14 +3,20 @@ load_dotenv()
 
 import os
 import json
+import time
+import argparse
 import logging
 from datetime import datetime
 from pymongo import MongoClient
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_values
 import uuid
 import traceback
 from bson import ObjectId
+from mongo_stream import iter_chunks, stream_collection
+from mongo_id_index import load_existing_mongo_ids, skip_existing
+from id_map_store import ID_MAP_FILE, write_id_map
+from user_uuid import objectid_to_uuid
 
 # Configuration du logging
 logging.basicConfig(
@@ -23,6 +29,54 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Fichier du mapping MongoDB -> Supabase des utilisateurs
+MAPPING_FILE = 'mongo_to_supabase_ids.json'
+
+# Nombre d'utilisateurs migrés entre deux sauvegardes du mapping
+MAPPING_FLUSH_EVERY = 500
+
+# Nombre d'utilisateurs insérés par transaction en mode batch
+USER_BATCH_SIZE = 500
+
+# Colonnes insérées dans education.users, dans l'ordre de build_user_row
+USER_COLUMNS = (
+    'id', 'mongo_id', 'email', 'secondary_mail', 'has_invalid_email',
+    'firstname', 'lastname', 'role', 'phone', 'date_of_birth', 'gender',
+    'type', 'subjects', 'school_year', 'is_active', 'deleted_at',
+    'stats_model', 'created_at', 'updated_at'
+)
+
+# Nombre d'utilisateurs MongoDB récupérés par requête $in lors de la vérification
+VERIFY_CHUNK_SIZE = 500
+
+# Champs MongoDB comparés lors de la vérification
+VERIFY_PROJECTION = {
+    'firstname': 1,
+    'lastname': 1,
+    'email': 1
+}
+
+# Champs MongoDB lus par la migration des utilisateurs
+USER_PROJECTION = {
+    'email': 1,
+    'secondaryEmail': 1,
+    'hasInvalidEmail': 1,
+    'firstname': 1,
+    'lastname': 1,
+    'role': 1,
+    'phone': 1,
+    'dateOfBirth': 1,
+    'gender': 1,
+    'type': 1,
+    'subjects': 1,
+    'schoolYear': 1,
+    'isActive': 1,
+    'deletedAt': 1,
+    'statsModel': 1,
+    'createdAt': 1,
+    'updatedAt': 1
+}
+
 def connect_mongodb():
     """Connexion à MongoDB"""
     try:
@@ -53,51 +107,72 @@ def connect_supabase():
         logger.error(f"Erreur de connexion à Supabase: {str(e)}")
         raise
 
-def objectid_to_uuid(objectid: ObjectId) -> str:
-    """Convertit un ObjectId MongoDB en UUID string"""
-    # Convertir l'ObjectId en hexadécimal
-    hex_str = str(objectid)
-    # S'assurer que nous avons 32 caractères hexadécimaux
-    hex_str = hex_str.ljust(32, '0')
-    # Formater en UUID standard (8-4-4-4-12 caractères)
-    return f"{hex_str[:8]}-{hex_str[8:12]}-{hex_str[12:16]}-{hex_str[16:20]}-{hex_str[20:32]}"
-
 def get_mongo_users(db):
-    """Récupère tous les utilisateurs depuis MongoDB"""
+    """Renvoie un itérateur en streaming sur les utilisateurs MongoDB"""
     try:
         # Vérifier que la collection existe
         if 'usernews' not in db.list_collection_names():
             raise ValueError("La collection 'usernews' n'existe pas dans MongoDB")
 
-        users = list(db.usernews.find())
-        if not users:
+        count = db.usernews.estimated_document_count()
+        if not count:
             logger.warning("Aucun utilisateur trouvé dans MongoDB")
-            return []
 
-        logger.info(f"Nombre d'utilisateurs trouvés dans MongoDB: {len(users)}")
-        return users
+        logger.info(f"Nombre d'utilisateurs trouvés dans MongoDB: {count}")
+        return stream_collection(db, 'usernews', USER_PROJECTION)
     except Exception as e:
         logger.error(f"Erreur lors de la récupération des utilisateurs MongoDB: {str(e)}")
         raise
 
-def migrate_user(pg_conn, mongo_user):
+def is_valid_user(mongo_user):
+    """Vérifie les champs obligatoires d'un utilisateur avant insertion"""
+    if not mongo_user.get('firstname') or not mongo_user.get('lastname'):
+        logger.warning(f"L'utilisateur {mongo_user['_id']} n'a pas de prénom ou de nom, il sera ignoré")
+        return False
+    return True
+
+def build_user_row(mongo_user):
+    """Construit la ligne education.users d'un utilisateur, dans l'ordre de USER_COLUMNS"""
+    return (
+        objectid_to_uuid(mongo_user['_id']),
+        str(mongo_user['_id']),
+        mongo_user.get('email'),
+        mongo_user.get('secondaryEmail'),
+        mongo_user.get('hasInvalidEmail', False),
+        mongo_user.get('firstname'),
+        mongo_user.get('lastname'),
+        mongo_user.get('role'),
+        mongo_user.get('phone'),
+        mongo_user.get('dateOfBirth'),
+        mongo_user.get('gender'),
+        mongo_user.get('type'),
+        mongo_user.get('subjects', []),
+        mongo_user.get('schoolYear'),
+        mongo_user.get('isActive', True),
+        mongo_user.get('deletedAt'),
+        mongo_user.get('statsModel'),
+        mongo_user.get('createdAt', datetime.now()),
+        mongo_user.get('updatedAt', datetime.now())
+    )
+
+def migrate_user(pg_conn, mongo_user, check_existing=True):
     """Migre un utilisateur de MongoDB vers Supabase"""
     try:
         cur = pg_conn.cursor()
 
-        # Vérifier que l'utilisateur n'existe pas déjà
-        cur.execute("""
-            SELECT id FROM education.users
-            WHERE mongo_id = %s
-        """, (str(mongo_user['_id']),))
+        # Vérifier que l'utilisateur n'existe pas déjà (déjà filtré en amont en mode reprise)
+        if check_existing:
+            cur.execute("""
+                SELECT id FROM education.users
+                WHERE mongo_id = %s
+            """, (str(mongo_user['_id']),))
 
-        if cur.fetchone():
-            logger.warning(f"L'utilisateur {mongo_user['_id']} existe déjà dans Supabase, il sera ignoré")
-            return
+            if cur.fetchone():
+                logger.warning(f"L'utilisateur {mongo_user['_id']} existe déjà dans Supabase, il sera ignoré")
+                return
 
         # Vérifier les champs obligatoires
-        if not mongo_user.get('firstname') or not mongo_user.get('lastname'):
-            logger.warning(f"L'utilisateur {mongo_user['_id']} n'a pas de prénom ou de nom, il sera ignoré")
+        if not is_valid_user(mongo_user):
             return
 
         # Insérer l'utilisateur
@@ -143,34 +218,12 @@ def migrate_user(pg_conn, mongo_user):
                 %s,
                 %s
             ) RETURNING id
-        """, (
-            objectid_to_uuid(mongo_user['_id']),
-            str(mongo_user['_id']),
-            mongo_user.get('email'),
-            mongo_user.get('secondaryEmail'),
-            mongo_user.get('hasInvalidEmail', False),
-            mongo_user.get('firstname'),
-            mongo_user.get('lastname'),
-            mongo_user.get('role'),
-            mongo_user.get('phone'),
-            mongo_user.get('dateOfBirth'),
-            mongo_user.get('gender'),
-            mongo_user.get('type'),
-            mongo_user.get('subjects', []),
-            mongo_user.get('schoolYear'),
-            mongo_user.get('isActive', True),
-            mongo_user.get('deletedAt'),
-            mongo_user.get('statsModel'),
-            mongo_user.get('createdAt', datetime.now()),
-            mongo_user.get('updatedAt', datetime.now())
-        ))
+        """, build_user_row(mongo_user))
         user_id = cur.fetchone()[0]
 
         pg_conn.commit()
         logger.info(f"Utilisateur {mongo_user['_id']} migré avec succès")
-
-        # Mettre à jour le mapping des IDs
-        update_id_mapping(mongo_user, user_id)
+        return user_id
 
     except Exception as e:
         pg_conn.rollback()
@@ -180,39 +233,105 @@ def migrate_user(pg_conn, mongo_user):
     finally:
         cur.close()
 
-def update_id_mapping(mongo_user, supabase_id):
-    """Met à jour le fichier de mapping des IDs"""
+def migrate_users_batch(pg_conn, mongo_users, check_existing=True):
+    """Migre une page d'utilisateurs en une seule transaction avec un INSERT multi-lignes"""
     try:
-        mapping_file = 'mongo_to_supabase_ids.json'
-        mapping = {}
-
-        # Charger le mapping existant s'il existe
-        if os.path.exists(mapping_file):
-            with open(mapping_file, 'r') as f:
-                mapping = json.load(f)
-
-        # Créer une clé unique basée sur le prénom et le nom
-        user_key = f"{mongo_user.get('firstname', '').lower()}_{mongo_user.get('lastname', '').lower()}"
-
-        # Mettre à jour le mapping
-        mapping[user_key] = {
-            "mongo_id": str(mongo_user['_id']),
-            "supabase_id": supabase_id,
-            "email": mongo_user.get('email'),
-            "firstname": mongo_user.get('firstname'),
-            "lastname": mongo_user.get('lastname')
+        cur = pg_conn.cursor()
+
+        # Utilisateurs de la page déjà migrés, en une seule requête
+        existing_ids = set()
+        if check_existing:
+            cur.execute("""
+                SELECT mongo_id FROM education.users
+                WHERE mongo_id = ANY(%s)
+            """, ([str(u['_id']) for u in mongo_users],))
+            existing_ids = {row[0] for row in cur.fetchall()}
+
+        # Validation et filtrage en Python avant l'envoi de la page
+        rows = []
+        migrated = []
+        for mongo_user in mongo_users:
+            if str(mongo_user['_id']) in existing_ids:
+                logger.warning(f"L'utilisateur {mongo_user['_id']} existe déjà dans Supabase, il sera ignoré")
+                continue
+            if not is_valid_user(mongo_user):
+                continue
+
+            row = build_user_row(mongo_user)
+            rows.append(row)
+            migrated.append((mongo_user, row[0]))
+
+        if rows:
+            execute_values(
+                cur,
+                f"INSERT INTO education.users ({', '.join(USER_COLUMNS)}) VALUES %s",
+                rows
+            )
+
+        pg_conn.commit()
+        logger.info(f"Page de {len(migrated)} utilisateurs migrée avec succès")
+        return migrated
+
+    except Exception as e:
+        pg_conn.rollback()
+        logger.error(f"Erreur lors de la migration de la page d'utilisateurs: {str(e)}")
+        raise
+    finally:
+        cur.close()
+
+def load_id_mapping():
+    """Charge le mapping des IDs existant, indexé par mongo_id, ou un mapping vide"""
+    try:
+        if not os.path.exists(MAPPING_FILE):
+            return {}
+        with open(MAPPING_FILE, 'r') as f:
+            data = json.load(f)
+
+        # Les anciens fichiers sont indexés par "prénom_nom", ce qui écrase les homonymes
+        return {
+            user_data['mongo_id']: user_data
+            for user_data in data.values()
+            if user_data.get('mongo_id')
         }
+    except Exception as e:
+        logger.error(f"Erreur lors du chargement du mapping des IDs: {str(e)}")
+        raise
 
-        # Sauvegarder le mapping
-        with open(mapping_file, 'w') as f:
+def update_id_mapping(mapping, mongo_user, supabase_id):
+    """Met à jour en mémoire le mapping des IDs"""
+    mapping[str(mongo_user['_id'])] = {
+        "mongo_id": str(mongo_user['_id']),
+        "supabase_id": supabase_id,
+        "email": mongo_user.get('email'),
+        "firstname": mongo_user.get('firstname'),
+        "lastname": mongo_user.get('lastname')
+    }
+
+def save_id_mapping(mapping):
+    """Sauvegarde atomiquement le mapping des IDs (fichier temporaire puis renommage)"""
+    try:
+        tmp_file = f"{MAPPING_FILE}.tmp"
+        with open(tmp_file, 'w') as f:
             json.dump(mapping, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+
+        # Le renommage remplace le fichier d'un bloc : un arrêt brutal ne le laisse jamais à moitié écrit
+        os.replace(tmp_file, MAPPING_FILE)
+
+        # Mapping binaire partagé, lu par les autres scripts de migration
+        write_id_map(
+            {mongo_id: user_data['supabase_id'] for mongo_id, user_data in mapping.items()},
+            ID_MAP_FILE
+        )
+        logger.info(f"Mapping des IDs sauvegardé: {len(mapping)} entrées")
 
     except Exception as e:
-        logger.error(f"Erreur lors de la mise à jour du mapping des IDs: {str(e)}")
+        logger.error(f"Erreur lors de la sauvegarde du mapping des IDs: {str(e)}")
         raise
 
-def verify_migration(pg_conn, mongo_db):
-    """Vérifie que la migration s'est bien passée"""
+def verify_migration(pg_conn, mongo_db, chunk_size=VERIFY_CHUNK_SIZE):
+    """Vérifie que la migration s'est bien passée, en lisant MongoDB par lots $in"""
     try:
         cur = pg_conn.cursor()
 
@@ -224,25 +343,38 @@ def verify_migration(pg_conn, mongo_db):
         migrated_users = cur.fetchall()
 
         logger.info(f"Vérification de {len(migrated_users)} utilisateurs migrés...")
-
-        for user in migrated_users:
-            supabase_id, mongo_id, firstname, lastname, email = user
-
-            # Récupérer l'utilisateur MongoDB
-            mongo_user = mongo_db.usernews.find_one({'_id': ObjectId(mongo_id)})
-            if not mongo_user:
-                logger.error(f"Utilisateur MongoDB {mongo_id} non trouvé")
-                continue
-
-            # Vérifier les champs de base
-            if mongo_user.get('firstname') != firstname:
-                logger.error(f"Différence de prénom pour l'utilisateur {mongo_id}")
-            if mongo_user.get('lastname') != lastname:
-                logger.error(f"Différence de nom pour l'utilisateur {mongo_id}")
-            if mongo_user.get('email') != email:
-                logger.error(f"Différence d'email pour l'utilisateur {mongo_id}")
-
-        logger.info("Vérification terminée")
+        start = time.monotonic()
+        verified = 0
+
+        for chunk in iter_chunks(migrated_users, chunk_size):
+            # Récupérer en une requête les utilisateurs MongoDB du lot
+            mongo_users = {
+                str(mongo_user['_id']): mongo_user
+                for mongo_user in mongo_db.usernews.find(
+                    {'_id': {'$in': [ObjectId(user[1]) for user in chunk]}},
+                    VERIFY_PROJECTION
+                )
+            }
+
+            for supabase_id, mongo_id, firstname, lastname, email in chunk:
+                mongo_user = mongo_users.get(mongo_id)
+                if not mongo_user:
+                    logger.error(f"Utilisateur MongoDB {mongo_id} non trouvé")
+                    continue
+
+                # Vérifier les champs de base
+                if mongo_user.get('firstname') != firstname:
+                    logger.error(f"Différence de prénom pour l'utilisateur {mongo_id}")
+                if mongo_user.get('lastname') != lastname:
+                    logger.error(f"Différence de nom pour l'utilisateur {mongo_id}")
+                if mongo_user.get('email') != email:
+                    logger.error(f"Différence d'email pour l'utilisateur {mongo_id}")
+
+            verified += len(chunk)
+
+        elapsed = time.monotonic() - start
+        rate = verified / elapsed if elapsed > 0 else float(verified)
+        logger.info(f"Vérification terminée: {verified} utilisateurs en {elapsed:.2f}s ({rate:.0f} utilisateurs/s)")
 
     except Exception as e:
         logger.error(f"Erreur lors de la vérification: {str(e)}")
@@ -304,8 +436,36 @@ def recreate_users_table(pg_conn):
     finally:
         cur.close()
 
+def parse_args():
+    """Analyse les arguments de la ligne de commande"""
+    parser = argparse.ArgumentParser(description="Migration des utilisateurs de MongoDB vers Supabase")
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help="Reprend une migration interrompue sans supprimer les tables, en ignorant les documents déjà migrés"
+    )
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help="Insère les utilisateurs par pages avec un INSERT multi-lignes par transaction"
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=USER_BATCH_SIZE,
+        help=f"Nombre d'utilisateurs par page en mode batch (défaut: {USER_BATCH_SIZE})"
+    )
+    parser.add_argument(
+        '--verify-chunk-size',
+        type=int,
+        default=VERIFY_CHUNK_SIZE,
+        help=f"Nombre d'utilisateurs MongoDB lus par requête lors de la vérification (défaut: {VERIFY_CHUNK_SIZE})"
+    )
+    return parser.parse_args()
+
 def main():
     """Fonction principale"""
+    args = parse_args()
     try:
         # Connexion à MongoDB
         mongo_db = connect_mongodb()
@@ -315,25 +475,74 @@ def main():
         pg_conn = connect_supabase()
         logger.info("Connexion à Supabase réussie")
 
-        # Recréer la table users
-        recreate_users_table(pg_conn)
-        logger.info("Table users recréée")
+        # Recréer la table users (conservée en mode reprise)
+        if not args.resume:
+            recreate_users_table(pg_conn)
+            logger.info("Table users recréée")
 
         # Récupérer les utilisateurs de MongoDB
         mongo_users = get_mongo_users(mongo_db)
-        logger.info(f"Nombre d'utilisateurs à migrer: {len(mongo_users)}")
 
-        # Migrer chaque utilisateur
-        for user in mongo_users:
-            migrate_user(pg_conn, user)
+        # En mode reprise, écarter en amont les utilisateurs déjà migrés
+        if args.resume:
+            existing_ids = load_existing_mongo_ids(pg_conn, 'education.users')
+            mongo_users = skip_existing(mongo_users, pg_conn, 'education.users', existing_ids)
+
+        # Migrer chaque utilisateur, en accumulant le mapping des IDs en mémoire
+        id_mapping = load_id_mapping()
+        pending = 0
+        if args.batch:
+            for i, page in enumerate(iter_chunks(mongo_users, args.batch_size), 1):
+                try:
+                    migrated = migrate_users_batch(pg_conn, page, check_existing=not args.resume)
+                except Exception:
+                    # Rejouer la page ligne par ligne pour isoler l'utilisateur en erreur
+                    logger.warning(f"Page {i} en erreur, migration utilisateur par utilisateur...")
+                    migrated = []
+                    for user in page:
+                        try:
+                            user_id = migrate_user(pg_conn, user, check_existing=not args.resume)
+                        except Exception as e:
+                            logger.error(f"Erreur lors de la migration de l'utilisateur {user['_id']}: {str(e)}")
+                            continue
+                        if user_id:
+                            migrated.append((user, user_id))
+
+                for user, user_id in migrated:
+                    update_id_mapping(id_mapping, user, user_id)
+                pending += len(migrated)
+
+                if pending >= MAPPING_FLUSH_EVERY:
+                    save_id_mapping(id_mapping)
+                    pending = 0
+        else:
+            for user in mongo_users:
+                user_id = migrate_user(pg_conn, user, check_existing=not args.resume)
+                if user_id:
+                    update_id_mapping(id_mapping, user, user_id)
+                    pending += 1
+
+                if pending >= MAPPING_FLUSH_EVERY:
+                    save_id_mapping(id_mapping)
+                    pending = 0
+
+        save_id_mapping(id_mapping)
+        pending = 0
 
         # Vérifier la migration
-        verify_migration(pg_conn, mongo_db)
+        verify_migration(pg_conn, mongo_db, args.verify_chunk_size)
 
         logger.info("Migration des utilisateurs terminée avec succès")
 
-    except Exception as e:
+    except (Exception, KeyboardInterrupt) as e:
         logger.error(f"Erreur lors de la migration: {str(e)}")
+        # Conserver les utilisateurs déjà migrés si la boucle a été interrompue,
+        # sans qu'un échec de la sauvegarde ne masque l'erreur d'origine
+        if 'id_mapping' in locals() and pending:
+            try:
+                save_id_mapping(id_mapping)
+            except Exception as save_error:
+                logger.error(f"Mapping des IDs non sauvegardé après l'erreur: {str(save_error)}")
         raise
     finally:
         if 'pg_conn' in locals():